@@ -14,20 +14,27 @@ import homeassistant.helpers.config_validation as cv
 
 from homeassistant.helpers import entity, service, event
 from homeassistant.const import (
-    SUN_EVENT_SUNSET, SUN_EVENT_SUNRISE)
+    SUN_EVENT_SUNSET, SUN_EVENT_SUNRISE, EVENT_STATE_CHANGED, ATTR_ENTITY_ID)
+from homeassistant.core import callback
 from homeassistant.util import dt
 from homeassistant.helpers.entity_component import EntityComponent
-import logging
-from transitions import Machine
-from transitions.extensions import HierarchicalMachine as Machine
-from threading import Timer
-from datetime import datetime, timedelta, date, time
+from bisect import bisect_left, bisect_right
+from collections import deque, namedtuple
+from heapq import heappop, heappush
+from functools import partial, lru_cache
+from datetime import datetime, timedelta, time
 import re
-from homeassistant.helpers.sun import get_astral_event_date
-
+import sys
+import json
+import os
+from time import monotonic
+
+# transitions, the HTTP view and the sun helpers are imported on first use,
+# so loading the component with the (default) compiled engine does not need
+# the transitions package at all
 DEPENDENCIES = ['light', 'sensor', 'binary_sensor', 'cover', 'fan',
                 'media_player']
-REQUIREMENTS = ['transitions==0.6.9']
+TRANSITIONS_REQUIREMENTS = ['transitions==0.6.9']
 
 DOMAIN = 'lightingsm'
 CONSTRAIN_START = 1
@@ -51,93 +58,366 @@ CONF_DELAY = 'delay'
 CONF_NIGHT_MODE = 'night_mode'
 CONFIG_START_TIME = 'start_time'
 CONFIG_END_TIME = 'end_time'
+CONF_LOG_LEVEL = 'log_level'
+CONF_TRACE_SIZE = 'trace_size'
+CONF_FILENAME = 'filename'
+DEFAULT_TRACE_SIZE = 50
+
+SERVICE_DUMP_TRACE = 'dump_trace'
+EVENT_TRACE = DOMAIN + '_trace'
+TRACE_FIELDS = ('time', 'trigger', 'source', 'dest', 'cause', 'conditions')
+DUMP_TRACE_SCHEMA = vol.Schema({
+    vol.Optional(ATTR_ENTITY_ID): cv.entity_ids,
+    # a file in the configuration directory, paths are not allowed
+    vol.Optional(CONF_FILENAME): vol.All(
+        cv.string, vol.Match(r'^\w[\w.-]*$',
+                             msg="filename must not contain a path")),
+})
+
+CONF_OPTIONS = 'options'  # reserved key for component-wide options
+DIAGNOSTICS = 'diagnostics'  # reserved, object id of the diagnostics entity
+CONF_ENGINE = 'engine'
+CONF_LATENCY = 'latency'
+CONF_METRICS = 'metrics'
+CONF_METRICS_FILE = 'metrics_file'
+ENGINE_TRANSITIONS = 'transitions'
+ENGINE_COMPILED = 'compiled'
+DEFAULT_ENGINE = ENGINE_COMPILED
+
+TIME_DATETIME = 'datetime'  # 2019-01-17 22:00:00
+TIME_OF_DAY = 'time'  # 22:00:00
+TIME_SUN = 'sun'  # sunset - 00:30:00
+TIME_NOW = 'now'  # now + 10 (5), debugging only
+RE_DATETIME = re.compile(r'^(\d+)-(\d+)-(\d+)\s+(\d+):(\d+):(\d+)$')
+RE_TIME = re.compile(r'^(\d+):(\d+):(\d+)$')
+RE_SUN = re.compile(
+    r'^(sunrise|sunset)(?:\s*([+-])\s*(\d+):(\d+):(\d+))?$')
+RE_NOW = re.compile(r'^now\s*([+-])\s*(\d+)\s*\(?(\d+)?\)?$')
+
+DATA_CLOCK = 'clock'
+DATA_TIMERS = 'timers'
+DATA_ROUTER = 'router'
+DATA_SUN = 'sun'
+DATA_CONSTRAINTS = 'constraints'
+DATA_LATENCY = 'latency'
+DATA_METRICS = 'metrics'
+DATA_SETUP = 'setup'  # seconds spent in each phase of async_setup
+SETUP_CHUNK_SIZE = 100  # entities added to HA at a time
+METRICS_URL = '/api/' + DOMAIN + '/metrics'
+METRICS_INTERVAL = timedelta(seconds=60)  # metrics file write interval
+METRIC_TRANSITIONS = DOMAIN + '_transitions_total'
+METRIC_TIMERS = DOMAIN + '_timer_operations_total'
+METRIC_BACKOFF = DOMAIN + '_backoff_increments_total'
+METRIC_SERVICE_CALLS = DOMAIN + '_service_calls_total'
+METRIC_SENSOR_EVENTS = DOMAIN + '_sensor_events_total'
+METRICS = [
+    # (name, help, label names)
+    (METRIC_TRANSITIONS, 'Triggers processed by the state machines.',
+     ('source', 'dest', 'trigger')),
+    (METRIC_TIMERS, 'Timers started, reset and cancelled.', ('operation',)),
+    (METRIC_BACKOFF, 'Backoff increments of timer delays.', ()),
+    (METRIC_SERVICE_CALLS, 'Service calls made to control entities.',
+     ('domain', 'service')),
+    (METRIC_SENSOR_EVENTS, 'Sensor state changes that triggered, were '
+     'suppressed by the current state or were ignored.', ('outcome',)),
+]
+SENSOR_EVENT_TRIGGERED = 'triggered'
+SENSOR_EVENT_SUPPRESSED = 'suppressed'
+SENSOR_EVENT_IGNORED = 'ignored'
+TIMER_RESOLUTION = 1  # seconds covered by one timer wheel slot
+TIMER_SLOTS = 512
+# roles index Model.on_entities and the `on` fields of StateStrings
+ROLE_SENSOR = 0
+ROLE_STATE = 1
+ROLE_OVERRIDE = 2
+LATENCY_EVENT_TO_TRANSITION = 'event_to_transition'
+LATENCY_TRANSITION_TO_DISPATCH = 'transition_to_dispatch'
+LATENCY_SERVICE_CALL = 'service_call'
+LATENCY_STAGES = [LATENCY_EVENT_TO_TRANSITION, LATENCY_TRANSITION_TO_DISPATCH,
+                  LATENCY_SERVICE_CALL]
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5)  # upper bounds in seconds
+LOG_LEVELS = ['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL']
+
+# A validated motion light, see entry_record
+EntryConfig = namedtuple('EntryConfig', [
+    'name', 'friendly_name', 'sensors', 'entities', 'state_entities',
+    'overrides', 'off_entities', 'sensor_type', 'strings', 'day_params',
+    'night_params', 'night_start', 'night_end', 'start_time', 'end_time',
+    'stay', 'backoff', 'backoff_factor', 'backoff_max', 'day_length',
+    'draw', 'image_path', 'image_prefix', 'log_level', 'trace_size'])
+
+
+def time_expression(value):
+    """ Validates a time string and returns its TimeExpression """
+    expression = parse_time_expression(cv.string(value))
+    if expression is None:
+        raise vol.Invalid("Invalid time: %s" % value)
+    return expression
+
+
+def not_diagnostics(config):
+    """ Rejects a motion light named like the diagnostics entity """
+    if DIAGNOSTICS in (key.lower() for key in config):
+        raise vol.Invalid("'%s' is reserved and cannot be used as a motion "
+                          "light name" % DIAGNOSTICS)
+    return config
+
+
+def entry_records(config):
+    """ Replaces the validated motion light entries by EntryConfig records """
+    return {key: value if key == CONF_OPTIONS else entry_record(key, value)
+            for key, value in config.items()}
+
+
+STATE_STRINGS = vol.All(cv.ensure_list, [cv.string])
+NIGHT_MODE_SCHEMA = vol.Schema({
+    vol.Required(CONFIG_START_TIME): time_expression,
+    vol.Required(CONFIG_END_TIME): time_expression,
+    vol.Optional(CONF_DELAY): cv.positive_int,
+    vol.Optional('service_data'): dict,
+})
+ENTRY_SCHEMA = vol.All(vol.Schema({
+    vol.Optional('friendly_name'): cv.string,
+    vol.Optional('sensor'): cv.entity_ids,
+    vol.Optional(CONF_SENSORS): cv.entity_ids,
+    vol.Optional('entity'): cv.entity_ids,
+    vol.Optional(CONF_CONTROL): cv.entity_ids,
+    vol.Optional('entity_on'): cv.entity_ids,
+    vol.Optional('entity_off'): cv.entity_ids,
+    vol.Optional(CONF_STATE): cv.entity_ids,
+    vol.Optional('override'): cv.entity_ids,
+    vol.Optional('overrides'): cv.entity_ids,
+    vol.Optional('sensor_type_duration', default=False): cv.boolean,
+    vol.Optional(CONF_DELAY, default=DEFAULT_DELAY): cv.positive_int,
+    vol.Optional('service_data'): dict,
+    vol.Optional(CONF_NIGHT_MODE): NIGHT_MODE_SCHEMA,
+    vol.Inclusive(CONFIG_START_TIME, 'time window'): time_expression,
+    vol.Inclusive(CONFIG_END_TIME, 'time window'): time_expression,
+    vol.Optional('stay', default=False): cv.boolean,
+    vol.Optional('backoff', default=False): cv.boolean,
+    vol.Optional('backoff_factor', default=1.1): vol.Coerce(float),
+    vol.Optional('backoff_max', default=300): cv.positive_int,
+    vol.Optional('state_strings_on'): STATE_STRINGS,
+    vol.Optional('state_strings_off'): STATE_STRINGS,
+    vol.Optional('sensor_states_on'): STATE_STRINGS,
+    vol.Optional('sensor_states_off'): STATE_STRINGS,
+    vol.Optional('state_states_on'): STATE_STRINGS,
+    vol.Optional('state_states_off'): STATE_STRINGS,
+    vol.Optional('override_states_on'): STATE_STRINGS,
+    vol.Optional('override_states_off'): STATE_STRINGS,
+    vol.Optional('control_states_on'): STATE_STRINGS,
+    vol.Optional('control_states_off'): STATE_STRINGS,
+    vol.Optional('day_length'): cv.positive_int,
+    vol.Optional('draw', default=False): cv.boolean,
+    vol.Optional('image_path', default='/conf/temp'): cv.string,
+    vol.Optional('image_prefix', default='/fsm_diagram_'): cv.string,
+    vol.Optional(CONF_LOG_LEVEL): vol.All(cv.string, vol.Upper,
+                                          vol.In(LOG_LEVELS)),
+    vol.Optional(CONF_TRACE_SIZE, default=DEFAULT_TRACE_SIZE):
+        cv.positive_int,
+}), cv.has_at_least_one_key('sensor', CONF_SENSORS),
+    cv.has_at_least_one_key('entity', CONF_CONTROL, 'entity_on'))
+OPTIONS_SCHEMA = vol.Schema({
+    vol.Optional(CONF_ENGINE, default=DEFAULT_ENGINE):
+        vol.In([ENGINE_TRANSITIONS, ENGINE_COMPILED]),
+    vol.Optional(CONF_LATENCY, default=False): cv.boolean,
+    vol.Optional(CONF_METRICS, default=False): cv.boolean,
+    vol.Optional(CONF_METRICS_FILE): cv.string,
+})
+CONFIG_SCHEMA = vol.Schema({
+    DOMAIN: vol.All(vol.Schema({
+        vol.Optional(CONF_OPTIONS, default={}): OPTIONS_SCHEMA,
+        cv.string: ENTRY_SCHEMA,
+    }), not_diagnostics, entry_records)
+}, extra=vol.ALLOW_EXTRA)
+
 STATES = ['idle', 'overridden', 'constrained', 'blocked',
           {'name': 'active', 'children': ['timer', 'stay_on'],
            'initial': False}]
 
-_LOGGER = logging.getLogger(__name__)
-devices = []
-
+TRANSITIONS = [
+    dict(trigger='constrain', source='*', dest='constrained'),
+    dict(trigger='override', source=['idle', 'active_timer', 'blocked'],
+         dest='overridden'),
 
-async def async_setup(hass, config):
-    """Load graph configurations."""
-
-    component = EntityComponent(
-        _LOGGER, DOMAIN, hass)
+    # Idle
+    # dict(trigger='sensor_off',           source='idle',              dest=None),
+    dict(trigger='sensor_on', source='idle', dest='active',
+         conditions=['is_state_entities_off']),
+    dict(trigger='sensor_on', source='idle', dest='blocked',
+         conditions=['is_state_entities_on']),
 
-    myconfig = config[DOMAIN]
+    # Blocked
+    dict(trigger='enable', source='blocked', dest='idle'),
+    dict(trigger='sensor_on', source='blocked',
+         dest='blocked'),  # re-entering self-transition (on_enter callback executed.)
 
-    _LOGGER.info("Component Configuration: " + str(myconfig))
+    # Overridden
+    dict(trigger='enable', source='overridden', dest='idle'),
+    # dict(trigger='sensor_off',           source=['overridden'],          dest=None),
 
-    machine = Machine(states=STATES,
-                      initial='idle',
-                      # title=self.name+" State Diagram",
-                      # show_conditions=True
-                      # show_auto_transitions = True,
-                      finalize_event='finalize'
-                      )
+    dict(trigger='enter', source='active', dest='active_timer',
+         unless='will_stay_on'),
+    dict(trigger='enter', source='active', dest='active_stay_on',
+         conditions='will_stay_on'),
 
-    machine.add_transition(trigger='constrain', source='*', dest='constrained')
-    machine.add_transition(trigger='override',
-                           source=['idle', 'active_timer', 'blocked'],
-                           dest='overridden')
+    # Active Timer
+    dict(trigger='sensor_on', source='active_timer', dest=None,
+         after='_reset_timer'),
+    # dict(trigger='sensor_off',           source='active_timer',      dest=None,              conditions=['is_event_sensor']),
+    dict(trigger='sensor_off_duration', source='active_timer', dest='idle',
+         conditions=['is_timer_expired']),
+    dict(trigger='timer_expires', source='active_timer', dest='idle',
+         conditions=['is_event_sensor']),
+    dict(trigger='timer_expires', source='active_timer', dest='idle',
+         conditions=['is_duration_sensor', 'is_sensor_off']),
+    dict(trigger='control', source='active_timer', dest='idle',
+         conditions=['is_state_entities_off']),
+
+    # dict(trigger='sensor_off',           source='active_stay_on',    dest=None),
+    dict(trigger='timer_expires', source='active_stay_on', dest=None),
 
-    # Idle
-    # machine.add_transition(trigger='sensor_off',           source='idle',              dest=None)
-    machine.add_transition(trigger='sensor_on', source='idle', dest='active',
-                           conditions=['is_state_entities_off'])
-    machine.add_transition(trigger='sensor_on', source='idle', dest='blocked',
-                           conditions=['is_state_entities_on'])
+    # Constrained
+    dict(trigger='enable', source='constrained', dest='idle'),
+]
 
-    # Blocked
-    machine.add_transition(trigger='enable', source='blocked', dest='idle')
-    machine.add_transition(trigger='sensor_on', source='blocked',
-                           dest='blocked')  # re-entering self-transition (on_enter callback executed.)
+_LOGGER = logging.getLogger(__name__)
+devices = []
 
-    # Overridden      
-    machine.add_transition(trigger='enable', source='overridden', dest='idle')
 
-    # machine.add_transition(trigger='sensor_off',           source=['overridden'],          dest=None)
+async def async_setup(hass, config):
+    """Load graph configurations."""
+    started = mark = monotonic()
+    timings = {}
 
-    machine.add_transition(trigger='enter', source='active',
-                           dest='active_timer', unless='will_stay_on')
-    machine.add_transition(trigger='enter', source='active',
-                           dest='active_stay_on', conditions='will_stay_on')
+    def phase(name):
+        """ Records the time since the previous phase ended """
+        nonlocal mark
+        now = monotonic()
+        timings[name] = round(now - mark, 4)
+        mark = now
 
-    # Active Timer
-    machine.add_transition(trigger='sensor_on', source='active_timer',
-                           dest=None, after='_reset_timer')
-    # machine.add_transition(trigger='sensor_off',           source='active_timer',      dest=None,              conditions=['is_event_sensor'])
-    machine.add_transition(trigger='sensor_off_duration',
-                           source='active_timer', dest='idle',
-                           conditions=['is_timer_expired'])
-    machine.add_transition(trigger='timer_expires', source='active_timer',
-                           dest='idle', conditions=['is_event_sensor'])
-    machine.add_transition(trigger='timer_expires', source='active_timer',
-                           dest='idle',
-                           conditions=['is_duration_sensor', 'is_sensor_off'])
-    machine.add_transition(trigger='control', source='active_timer',
-                           dest='idle', conditions=['is_state_entities_off'])
-
-    # machine.add_transition(trigger='sensor_off',           source='active_stay_on',    dest=None)
-    machine.add_transition(trigger='timer_expires', source='active_stay_on',
-                           dest=None)
+    component = EntityComponent(
+        _LOGGER, DOMAIN, hass)
 
-    # Constrained
-    machine.add_transition(trigger='enable', source='constrained', dest='idle')
+    myconfig = config[DOMAIN]
 
+    options = myconfig[CONF_OPTIONS]
+    # tests and simulations seed hass.data with a VirtualClock before setup
+    clock = hass.data.get(DOMAIN, {}).get(DATA_CLOCK) or HassClock(hass)
+    router = StateChangeRouter(hass)
+    hass.data[DOMAIN] = {
+        DATA_CLOCK: clock,
+        DATA_TIMERS: TimerWheel(clock),
+        DATA_ROUTER: router,
+        DATA_SUN: SunCache(hass, clock),
+        DATA_CONSTRAINTS: ConstraintScheduler(clock),
+        DATA_SETUP: timings
+    }
+
+    _LOGGER.debug("Component Configuration: %s", myconfig)
+
+    # latency statistics are only collected (and paid for) when enabled
+    latency = LatencyStats() if options[CONF_LATENCY] else None
+    hass.data[DOMAIN][DATA_LATENCY] = latency
+    metrics = None
+    if options[CONF_METRICS]:
+        metrics = hass.data[DOMAIN][DATA_METRICS] = MetricsRegistry()
+    else:
+        hass.data[DOMAIN][DATA_METRICS] = None
+    engine = options[CONF_ENGINE]
+    if engine == ENGINE_COMPILED:
+        machine = CompiledMachine(states=STATES,
+                                  transitions=TRANSITIONS,
+                                  initial='idle',
+                                  prepare_event='begin',
+                                  finalize_event='finalize')
+    else:
+        # installed on demand, like the REQUIREMENTS of a component
+        from homeassistant.requirements import async_process_requirements
+        if not await async_process_requirements(hass, DOMAIN,
+                                                TRANSITIONS_REQUIREMENTS):
+            _LOGGER.error("The %s engine requires %s", engine,
+                          TRANSITIONS_REQUIREMENTS[0])
+            return False
+        machine = transitions_machine()(states=STATES,
+                                        initial='idle',
+                                        auto_transitions=False,
+                                        prepare_event='begin',
+                                        finalize_event='finalize')
+        for transition in TRANSITIONS:
+            machine.add_transition(**transition)
+    _LOGGER.debug("Using %s state machine engine", engine)
+    phase('engine')
+
+    # the entries were validated (all at once) by CONFIG_SCHEMA
+    created = []
     for key, config in myconfig.items():
-        _LOGGER.info("Config Item %s: %s", str(key), str(config))
-        config["name"] = key
-        m = None
+        if key == CONF_OPTIONS:
+            continue
         m = LightingSM(hass, config, machine)
         # machine.add_model(m.model)
         # m.model.after_model(config)
-        devices.append(m)
+        created.append(m)
+    devices.extend(created)
+    phase('models')
+
+    @callback
+    def async_initial_update(now):
+        """ Writes the initial state of all new motion lights at once """
+        for device in created:
+            device.do_update()
+
+    clock.call_later(1, async_initial_update)
+    router.start()
+    entities = list(created)
+    if latency is not None:
+        entities.append(LightingSMDiagnostics(latency, created))
+    # adding in chunks lets other work run on the loop in between
+    for i in range(0, len(entities), SETUP_CHUNK_SIZE):
+        await component.async_add_entities(entities[i:i + SETUP_CHUNK_SIZE])
+    phase('entities')
+
+    if metrics is not None:
+        # the endpoint needs http, which is only set up on demand
+        from homeassistant.setup import async_setup_component
+        if await async_setup_component(hass, 'http', config):
+            hass.http.register_view(metrics_view()(metrics))
+        else:
+            _LOGGER.warning("http could not be set up, metrics are only "
+                            "written to metrics_file")
+        if CONF_METRICS_FILE in options:
+            path = hass.config.path(options[CONF_METRICS_FILE])
+
+            async def async_write_metrics(now):
+                await hass.async_add_executor_job(metrics.write, path)
+
+            event.async_track_time_interval(hass, async_write_metrics,
+                                            METRICS_INTERVAL)
+
+    async def async_dump_trace(call):
+        """ Fires an event with, or writes, the trace of the given entities """
+        entity_ids = call.data.get(ATTR_ENTITY_ID)
+        traces = {e.entity_id: e.model.dump_trace()
+                  for e in component.entities if isinstance(e, LightingSM)
+                  and (entity_ids is None or e.entity_id in entity_ids)}
+        filename = call.data.get(CONF_FILENAME)
+        if filename is None:
+            hass.bus.async_fire(EVENT_TRACE, {'traces': traces})
+        else:
+            await hass.async_add_executor_job(
+                write_trace, hass.config.path(filename), traces)
 
-    await component.async_add_entities(devices)
+    hass.services.async_register(DOMAIN, SERVICE_DUMP_TRACE,
+                                 async_dump_trace, schema=DUMP_TRACE_SCHEMA)
 
-    _LOGGER.info("The %s component is ready!", DOMAIN)
+    timings['total'] = round(monotonic() - started, 4)
+    _LOGGER.info("The %s component is ready! Set up %d motion lights in "
+                 "%.3fs (%s)", DOMAIN, len(created), timings['total'],
+                 ", ".join("%s %.3fs" % (name, seconds)
+                           for name, seconds in timings.items()
+                           if name != 'total'))
 
     return True
 
@@ -146,17 +426,11 @@ class LightingSM(entity.Entity):
 
     def __init__(self, hass, config, machine):
         self.attributes = {}
+        self.dirty = False  # attributes changed since the last state write
+        self.published_state = None  # state of the last state write
         self.may_update = False
-        self.model = None
-        self.friendly_name = config.get('name', 'Motion Light')
-        if 'friendly_name' in config:
-            self.friendly_name = config.get('friendly_name')
-        try:
-            self.model = Model(hass, config, machine, self)
-        except AttributeError as e:
-            self.log.error(
-                "Configuration error! Please ensure you use plural keys for lists. e.g. sensors, entities")
-        event.async_call_later(hass, 1, self.do_update)
+        self.friendly_name = config.friendly_name or config.name
+        self.model = Model(hass, config, machine, self)
 
     @property
     def state(self):
@@ -188,7 +462,8 @@ class LightingSM(entity.Entity):
     @property
     def state_attributes(self):
         """Return the state of the entity."""
-        return self.attributes.copy()
+        # HA copies the attributes into the new State, no need to copy here
+        return self.attributes
 
     def reset_state(self):
         """ Reset state attributes by removing any state specific attributes when returning to idle state """
@@ -212,19 +487,32 @@ class LightingSM(entity.Entity):
             if k in PERSISTED_STATE_ATTRIBUTES:
                 att[k] = v
 
-        self.attributes = att
-        self.do_update()
+        if att != self.attributes:
+            self.attributes = att
+            self.dirty = True
+        self.model.update()
 
     def do_update(self, wait=False, **kwargs):
-        """ Schedules an entity state update with HASS """
+        """
+            Schedules an entity state update with HASS. The write is skipped
+            if neither the state nor the attributes changed since the last one.
+        """
         # _LOGGER.debug("Scheduled update with HASS")
-        if self.may_update:
-            self.async_schedule_update_ha_state(True)
+        if not self.may_update:
+            return
+        state = self.state
+        if not self.dirty and state == self.published_state:
+            return
+        self.dirty = False
+        self.published_state = state
+        self.async_schedule_update_ha_state()
 
     def set_attr(self, k, v):
         if k == 'delay':
             v = str(v) + 's'
-        self.attributes[k] = v
+        if k not in self.attributes or self.attributes[k] != v:
+            self.attributes[k] = v
+            self.dirty = True
 
     # HA Callbacks
     async def async_added_to_hass(self):
@@ -232,20 +520,84 @@ class LightingSM(entity.Entity):
         self.may_update = True
 
 
+class LightingSMDiagnostics(entity.Entity):
+    """ Exposes the latency statistics of all motion lights as attributes """
+
+    def __init__(self, latency, devices):
+        self.entity_id = DOMAIN + '.' + DIAGNOSTICS
+        self.latency = latency
+        self.devices = devices
+
+    @property
+    def name(self):
+        """Return the name of the entity."""
+        return 'LightingSM Diagnostics'
+
+    @property
+    def icon(self):
+        """Return the entity icon."""
+        return 'mdi:chart-histogram'
+
+    @property
+    def state(self):
+        """Return the number of sensor events that activated a light."""
+        return self.latency.histograms[LATENCY_EVENT_TO_TRANSITION].count
+
+    @property
+    def state_attributes(self):
+        """Return the global and per-entity histograms."""
+        attributes = {'global': self.latency.as_dict()}
+        for device in self.devices:
+            if device.model is not None and device.entity_id is not None:
+                attributes[device.entity_id] = device.model.latency.as_dict()
+        return attributes
+
+
 class Model():
     """ Represents the transitions state machine model """
 
+    # Trigger methods and state checks are defined on the class (see below
+    # the class), so with the compiled engine no instance __dict__ is ever
+    # created. The transitions engine still binds a few helpers (`trigger`,
+    # `to`) to the first model of a machine, which end up in __dict__.
+    __slots__ = [
+        'hass', 'entity', 'machine', 'state', 'name', 'log',
+        'timers', 'router', 'sun', 'constraints', 'clock', 'latency',
+        'metrics', 'strings', 'stateEntities', 'controlEntities',
+        'sensorEntities', 'offEntities', 'overrideEntities', 'entityOff',
+        'on_entities', 'trigger_queue', 'dispatching', 'transaction', 'trace',
+        'cause', 'condition_results', 'event_at', 'timer_handle',
+        'sensor_type', 'stay', 'backoff', 'backoff_count', 'backoff_factor',
+        'backoff_max', 'previous_delay', 'light_params_day',
+        'light_params_night', 'lightParams', 'night_mode', 'night_index',
+        'constraint_index', 'debug_day_length', '_start_time_private',
+        '_end_time_private', 'start', 'end', 'reset_count', 'do_draw',
+        'image_prefix', 'image_path', '__dict__']
+
     def __init__(self, hass, config, machine, entity):
         self.hass = hass  # backwards reference to hass object
         self.entity = entity  # backwards reference to entity containing this model
-        self.debug_day_length = config.get("day_length", None)
-        self.stateEntities = []
-        self.controlEntities = []
-        self.sensorEntities = []
-        self.offEntities = []
+        self.debug_day_length = config.day_length
+        self.stateEntities = ()
+        self.controlEntities = ()
+        self.sensorEntities = ()
+        self.offEntities = ()
+        self.overrideEntities = ()
+        self.timers = hass.data[DOMAIN][DATA_TIMERS]
+        self.router = hass.data[DOMAIN][DATA_ROUTER]
+        self.sun = hass.data[DOMAIN][DATA_SUN]
+        self.constraints = hass.data[DOMAIN][DATA_CONSTRAINTS]
+        self.clock = hass.data[DOMAIN][DATA_CLOCK]
+        self.latency = None
+        if hass.data[DOMAIN][DATA_LATENCY] is not None:
+            self.latency = LatencyStats(hass.data[DOMAIN][DATA_LATENCY])
+        self.metrics = hass.data[DOMAIN][DATA_METRICS]
+        self.event_at = None  # monotonic time of the last sensor event
         self.timer_handle = None
         self.sensor_type = None
         self.night_mode = None
+        self.night_index = None
+        self.constraint_index = None
         self.backoff = False
         self.backoff_count = 0
         self.light_params_day = {}
@@ -256,14 +608,23 @@ class Model():
         self.start = None
         self.end = None
         self.reset_count = None
-        self.log = logging.getLogger(__name__ + '.' + config.get('name'))
-        self.log.setLevel(logging.DEBUG)
+        self.on_entities = (set(), set(), set())  # indexed by role
+        self.trigger_queue = deque()
+        self.dispatching = False
+        self.transaction = 0
+        self.trace = deque(maxlen=config.trace_size)
+        self.cause = None  # entity whose state change is being processed
+        self.condition_results = []  # (condition, result) of the current trigger
+        self.log = logging.getLogger(__name__ + '.' + config.name)
+        if config.log_level is not None:
+            self.log.setLevel(config.log_level)
         self.log.debug(
-            "Initialising LightingSM entity with this configuration: " + str(
-                config))
-        self.name = config.get('name', 'Unnamed Motion Light')
-        self.log.debug("Entity name: " + str(self.name))
+            "Initialising LightingSM entity with this configuration: %s",
+            config)
+        self.name = config.name
+        self.log.debug("Entity name: %s", self.name)
 
+        self.machine = machine
         machine.add_model(
             self)  # add here because machine generated methods are being used in methods below.
         self.config_static_strings(config)
@@ -286,69 +647,161 @@ class Model():
         #         self.get_graph().draw(self.image_path + self.image_prefix + str(self.name)+'.png', prog='dot', format='png')
 
     def update(self, wait=False, **kwargs):
-        """ Called from different methods to report a state attribute change """
+        """
+            Called from different methods to report a state attribute change.
+            Changes made during a transaction (e.g. while a trigger is being
+            processed) are written to HA once, when the transaction ends.
+        """
         # self.log.debug("Update called with {}".format(str(kwargs)))
         for k, v in kwargs.items():
             if v is not None:
                 self.entity.set_attr(k, v)
 
-        if wait == False:
+        if wait == False and self.transaction == 0:
+            self.entity.do_update()
+
+    def begin(self):
+        """ Starts a transaction, attribute changes are held back until commit """
+        self.transaction += 1
+
+    def commit(self):
+        """ Ends a transaction, writing the entity state once if anything changed """
+        self.transaction -= 1
+        if self.transaction == 0:
             self.entity.do_update()
 
     def finalize(self):
-        self.entity.do_update()
+        self.commit()
+
+    @callback
+    def fire(self, trigger):
+        """
+            Queues a state machine trigger for this model. Triggers are run
+            one at a time and in order on the event loop, so a trigger fired
+            while another one is being processed (e.g. by a transition
+            callback) runs once the current one has completed.
+        """
+        self.trigger_queue.append(trigger)
+        if self.dispatching:
+            return
+        self.dispatching = True
+        try:
+            while self.trigger_queue:
+                trigger = self.trigger_queue.popleft()
+                source = self.state
+                del self.condition_results[:]
+                try:
+                    getattr(self, trigger)()
+                except Exception:  # pylint: disable=broad-except
+                    self.log.exception("Error processing trigger %s in state %s",
+                                       trigger, self.state)
+                self.trace.append((monotonic(), trigger, source, self.state,
+                                   self.cause, tuple(self.condition_results)))
+                if self.metrics is not None:
+                    self.metrics.inc(METRIC_TRANSITIONS,
+                                     (source, self.state, trigger))
+        finally:
+            self.dispatching = False
+
+    def dump_trace(self):
+        """ Returns the trace buffer as a list of dicts, oldest first """
+        now = dt.now()
+        elapsed = monotonic()
+        return [dict(zip(TRACE_FIELDS, record),
+                     time=(now - timedelta(seconds=elapsed - record[0])).isoformat(),
+                     conditions=[list(c) for c in record[5]])
+                for record in self.trace]
 
     # =====================================================
     # S T A T E   C H A N G E   C A L L B A C K S
     # =====================================================
 
+    @callback
+    def track_state(self, role, entity, new):
+        """
+            Keeps the per-role set of entities that are currently on up to
+            date, so conditions do not have to poll hass.states.
+        """
+        if new is not None and new.state in self.strings[role]:
+            self.on_entities[role].add(entity)
+        else:
+            self.on_entities[role].discard(entity)
+
+    @callback
+    def route_state_change(self, role, entity, old, new):
+        """ Called by the StateChangeRouter for entities this model subscribed to """
+        self.begin()
+        self.cause = entity
+        try:
+            if role == ROLE_SENSOR:
+                self.sensor_state_change(entity, old, new)
+            elif role == ROLE_STATE:
+                self.state_entity_state_change(entity, old, new)
+            elif role == ROLE_OVERRIDE:
+                self.override_state_change(entity, old, new)
+        finally:
+            self.cause = None
+            self.commit()
+
+    @callback
     def sensor_state_change(self, entity, old, new):
         """ State change callback for sensor entities """
-        self.log.debug("Sensor state change: " + new.state)
-        self.log.debug("state: " + self.state)
-
-        if self.matches(new.state, self.SENSOR_ON_STATE) and (
-                self.is_idle() or self.is_active_timer() or self.is_blocked()):
-            self.update(last_triggered_by=entity)
-            self.sensor_on()
+        if self.latency is not None:
+            self.event_at = monotonic()
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("Sensor state change: %s (state: %s)",
+                           new.state, self.state)
+
+        outcome = SENSOR_EVENT_IGNORED
+        if new.state in self.strings.sensor_on:
+            if self.is_idle() or self.is_active_timer() or self.is_blocked():
+                self.update(last_triggered_by=entity)
+                self.fire('sensor_on')
+                outcome = SENSOR_EVENT_TRIGGERED
+            else:
+                outcome = SENSOR_EVENT_SUPPRESSED
 
-        if self.matches(new.state,
-                        self.SENSOR_OFF_STATE) and self.is_duration_sensor() and self.is_active_timer():
+        if new.state in self.strings.sensor_off and self.is_duration_sensor() and self.is_active_timer():
             self.update(last_triggered_by=entity,
-                        sensor_turned_off_at=datetime.now())
+                        sensor_turned_off_at=self.clock.naive_now())
             # We only care about sensor off state changes when the sensor is a duration sensor and we are in active_timer state.
-            self.sensor_off_duration()
+            self.fire('sensor_off_duration')
+            outcome = SENSOR_EVENT_TRIGGERED
+
+        if self.metrics is not None:
+            self.metrics.inc(METRIC_SENSOR_EVENTS, (outcome,))
 
+    @callback
     def override_state_change(self, entity, old, new):
         """ State change callback for override entities """
         self.log.debug("Override state change")
-        if self.matches(new.state, self.OVERRIDE_ON_STATE) and (
+        if new.state in self.strings.override_on and (
                 self.is_active() or self.is_active_timer() or self.is_idle() or self.is_blocked()):
             self.update(overridden_by=entity)
-            self.override()
-            self.update(overridden_at=str(datetime.now()))
-        if self.matches(new.state,
-                        self.OVERRIDE_OFF_STATE) and self.is_override_state_off() and self.is_overridden():
-            self.enable()
+            self.fire('override')
+            self.update(overridden_at=str(self.clock.naive_now()))
+        if new.state in self.strings.override_off and self.is_override_state_off() and self.is_overridden():
+            self.fire('enable')
 
+    @callback
     def state_entity_state_change(self, entity, old, new):
         """ State change callback for state entities """
         if self.is_active_timer():
-            self.control()
+            self.fire('control')
 
         if self.is_blocked() and self.is_state_entities_off():
-            self.enable()
+            self.fire('enable')
 
     def _start_timer(self):
-        self.log.info(self.lightParams)
         if self.backoff_count == 0:
             self.previous_delay = self.lightParams.get('delay', DEFAULT_DELAY)
         else:
-            self.log.debug(
-                "Backoff: %s,  count: %s, delay%s, factor: %s",
-                self.backoff, self.backoff_count,
-                self.lightParams.get('delay', DEFAULT_DELAY),
-                self.backoff_factor)
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug(
+                    "Backoff: %s,  count: %s, delay%s, factor: %s",
+                    self.backoff, self.backoff_count,
+                    self.lightParams.get('delay', DEFAULT_DELAY),
+                    self.backoff_factor)
             self.previous_delay = round(
                 self.previous_delay * self.backoff_factor, 2)
             if self.previous_delay > self.backoff_max:
@@ -357,28 +810,37 @@ class Model():
                 self.previous_delay = self.backoff_max
             self.update(delay=self.previous_delay)
 
-        expiry_time = datetime.now() + timedelta(seconds=self.previous_delay)
+        expiry_time = self.clock.naive_now() + timedelta(
+            seconds=self.previous_delay)
 
-        # not able to use async_call_later because no known way to check whether timer is active.
-        # self.timer_handle = event.async_call_later(self.hass, self.previous_delay, self.timer_expire)
-        # self.log.debug("Timer handle" + str(dir(self.timer_handle)))
-        self.timer_handle = Timer(self.previous_delay, self.timer_expire)
-        # self.log.debug("Delay: " + str(self.previous_delay))
-        self.timer_handle.start()
+        if self.metrics is not None:
+            self.metrics.inc(METRIC_TIMERS, ('start',))
+        # The handle is kept for the lifetime of the model and moved between
+        # wheel slots, so retriggers do not allocate new timers.
+        if self.timer_handle is None:
+            self.timer_handle = self.timers.schedule(self.previous_delay,
+                                                     self.timer_expire)
+        else:
+            self.timer_handle.reschedule(self.previous_delay)
         self.update(expires_at=expiry_time)
 
     def _cancel_timer(self):
-        if self.timer_handle.is_alive():
+        if self.timer_handle is not None and self.timer_handle.is_alive():
             self.timer_handle.cancel()
+            if self.metrics is not None:
+                self.metrics.inc(METRIC_TIMERS, ('cancel',))
 
     def _reset_timer(self):
-        self.log.debug("Resetting timer" + str(self.backoff))
-        self._cancel_timer()
-        self.update(reset_at=datetime.now())
+        self.log.debug("Resetting timer (backoff: %s)", self.backoff)
+        self.update(reset_at=self.clock.naive_now())
+        if self.metrics is not None:
+            self.metrics.inc(METRIC_TIMERS, ('reset',))
         if self.backoff:
             self.log.debug("inc backoff")
             self.backoff_count += 1
             self.update(backoff_count=self.backoff_count)
+            if self.metrics is not None:
+                self.metrics.inc(METRIC_BACKOFF)
         self._start_timer()
 
         return True
@@ -388,57 +850,39 @@ class Model():
         if self.is_duration_sensor() and self.is_sensor_on():  # Ignore timer expiry because duration sensor overwrites timer
             self.update(expires_at="pending sensor")
         else:
-            self.timer_expires()
+            self.fire('timer_expires')
 
     # =====================================================
     # S T A T E   M A C H I N E   C O N D I T I O N S
     # =====================================================
-    def _override_entity_state(self):
-        for e in self.overrideEntities:
-            s = self.hass.states.get(e)
-            if self.matches(s.state, self.OVERRIDE_ON_STATE):
-                self.log.debug("Override entities are ON. [%s]", e)
-                return e
-        self.log.debug("Override entities are OFF.")
-        return None
-
     def is_override_state_off(self):
-        return self._override_entity_state() is None
+        return not self.on_entities[ROLE_OVERRIDE]
 
     def is_override_state_on(self):
-        return self._override_entity_state() is not None
-
-    def _sensor_entity_state(self):
-        for e in self.sensorEntities:
-            s = self.hass.states.get(e)
-            if self.matches(s.state, self.SENSOR_ON_STATE):
-                self.log.debug("Sensor entities are ON. [%s]", e)
-                return e
-        self.log.debug("Sensor entities are OFF.")
-        return None
+        return bool(self.on_entities[ROLE_OVERRIDE])
 
     def is_sensor_off(self):
-        return self._sensor_entity_state() is None
+        return not self.on_entities[ROLE_SENSOR]
 
     def is_sensor_on(self):
-        return self._sensor_entity_state() is not None
+        return bool(self.on_entities[ROLE_SENSOR])
+
+    def is_state_entities_off(self):
+        return not self.on_entities[ROLE_STATE]
+
+    def is_state_entities_on(self):
+        return bool(self.on_entities[ROLE_STATE])
 
     def _state_entity_state(self):
+        """ First state entity that is on, in configured order. """
+        on = self.on_entities[ROLE_STATE]
         for e in self.stateEntities:
-            s = self.hass.states.get(e)
-            self.log.info(s)
-            if self.matches(s.state, self.STATE_ON_STATE):
+            if e in on:
                 self.log.debug("State entities are ON. [%s]", e)
                 return e
         self.log.debug("State entities are OFF.")
         return None
 
-    def is_state_entities_off(self):
-        return self._state_entity_state() is None
-
-    def is_state_entities_on(self):
-        return self._state_entity_state() is not None
-
     def will_stay_on(self):
         return self.stay
 
@@ -446,9 +890,10 @@ class Model():
         if self.night_mode is None:
             return False  # if night mode is undefined, it's never night :)
         else:
-            self.log.debug("NIGHT MODE ENABLED: " + str(self.night_mode))
-            return self.now_is_between(self.night_mode['start_time'],
-                                       self.night_mode['end_time'])
+            self.log.debug("NIGHT MODE ENABLED: %s", self.night_mode)
+            if self.night_index is not None:
+                return self.night_index.contains(self.clock.now())
+            return self.now_is_between(*self.night_mode)
 
     def is_event_sensor(self):
         return self.sensor_type == SENSOR_TYPE_EVENT
@@ -457,8 +902,8 @@ class Model():
         return self.sensor_type == SENSOR_TYPE_DURATION
 
     def is_timer_expired(self):
-        expired = self.timer_handle.is_alive() == False
-        self.log.debug("is_timer_expired -> " + str(expired))
+        expired = self.timer_handle is None or not self.timer_handle.is_alive()
+        self.log.debug("is_timer_expired -> %s", expired)
         return expired
 
     # =====================================================
@@ -475,29 +920,34 @@ class Model():
         self.log.debug("Now overridden")
 
     def on_enter_active(self):
-        self.update(last_triggered_at=str(datetime.now()))
+        if self.latency is not None:
+            transition_at = monotonic()
+            if self.event_at is not None:
+                self.latency.observe(LATENCY_EVENT_TO_TRANSITION,
+                                     transition_at - self.event_at)
+                self.event_at = None
+        self.update(last_triggered_at=str(self.clock.naive_now()))
         self.backoff_count = 0
         self.prepare_service_data()
 
         self._start_timer()
 
-        self.log.debug(
-            "light params before turning on: " + str(self.lightParams))
-        for e in self.controlEntities:
-
-            # self.log.debug("brightness value" + str(self.lightParams.get('brightness')))
-            if self.lightParams.get('service_data') is not None:
-                self.log.debug(
-                    "Turning on %s with service parameters %s", e,
-                    self.lightParams.get(
-                        'service_data'))
-                self.call_service(e, 'turn_on',
-                                  **self.lightParams.get('service_data'))
-            else:
-                self.log.debug(
-                    "Turning on %s (no parameters passed to service call)",
-                    e)
-                self.call_service(e, 'turn_on')
+        self.log.debug("light params before turning on: %s", self.lightParams)
+        # self.log.debug("brightness value" + str(self.lightParams.get('brightness')))
+        if self.lightParams.get('service_data') is not None:
+            self.log.debug(
+                "Turning on %s with service parameters %s",
+                self.controlEntities, self.lightParams.get('service_data'))
+            self.call_service(self.controlEntities, 'turn_on',
+                              **self.lightParams.get('service_data'))
+        else:
+            self.log.debug(
+                "Turning on %s (no parameters passed to service call)",
+                self.controlEntities)
+            self.call_service(self.controlEntities, 'turn_on')
+        if self.latency is not None:
+            self.latency.observe(LATENCY_TRANSITION_TO_DISPATCH,
+                                 monotonic() - transition_at)
         self.enter()
 
     def on_exit_active(self):
@@ -506,19 +956,17 @@ class Model():
         self.update(delay=self.lightParams.get(
             'delay'))  # no need to update immediately
         if len(self.offEntities) > 0:
-            self.log.info(
+            self.log.debug(
                 "Turning on special off_entities that were defined, "
                 "instead of turning off the regular control_entities")
-            for e in self.offEntities:
-                self.log.debug("Turning on %s", e)
-                self.call_service(e, 'turn_on')
+            self.log.debug("Turning on %s", self.offEntities)
+            self.call_service(self.offEntities, 'turn_on')
         else:
-            for e in self.controlEntities:
-                self.log.debug("Turning off %s", e)
-                self.call_service(e, 'turn_off')
+            self.log.debug("Turning off %s", self.controlEntities)
+            self.call_service(self.controlEntities, 'turn_off')
 
     def on_enter_blocked(self):
-        self.update(blocked_at=datetime.now())
+        self.update(blocked_at=self.clock.naive_now())
         self.update(blocked_by=self._state_entity_state())
 
     # =====================================================
@@ -526,79 +974,36 @@ class Model():
     # =====================================================
 
     def config_control_entities(self, config):
-
-        self.controlEntities = []
-
-        self.add(self.controlEntities, config, "entity")
-        self.add(self.controlEntities, config, "entities")
-        self.add(self.controlEntities, config, "entity_on")
-
-        self.log.debug("Control Entities: " + str(self.controlEntities))
+        self.controlEntities = config.entities
+        self.log.debug("Control Entities: %s", self.controlEntities)
 
     def config_state_entities(self, config):
-        self.stateEntities = []
-        if config.get('state_entities', False):
-            self.stateEntities.extend(config.get('state_entities', []))
-            self.log.info("State Entities (explicitly defined): " + str(
-                self.stateEntities))
-            event.async_track_state_change(self.hass, self.stateEntities,
-                                           self.state_entity_state_change)
+        if config.state_entities:
+            self.stateEntities = config.state_entities
+            self.log.debug("State Entities (explicitly defined): %s",
+                           self.stateEntities)
+            self.router.subscribe(self.stateEntities, self, ROLE_STATE)
 
         # If no state entities are defined, use control entites as state
         if len(self.stateEntities) == 0:
-            self.stateEntities = self.controlEntities.copy()
-            self.log.debug("Added Control Entities as state entities: " + str(
-                self.stateEntities))
-            event.async_track_state_change(self.hass, self.stateEntities,
-                                           self.state_entity_state_change)
+            self.stateEntities = self.controlEntities
+            self.log.debug("Added Control Entities as state entities: %s",
+                           self.stateEntities)
+            self.router.subscribe(self.stateEntities, self, ROLE_STATE)
 
     def config_off_entities(self, config):
-
-        self.offEntities = []
-        if self.add(self.offEntities, config, "entity_off"):
-            self.log.info('Off Entities: ' + str(self.offEntities))
+        if config.off_entities:
+            self.offEntities = config.off_entities
+            self.log.debug('Off Entities: %s', self.offEntities)
 
     def config_sensor_entities(self, config):
-        self.sensorEntities = []
-        self.add(self.sensorEntities, config, 'sensor')
-        self.add(self.sensorEntities, config, 'sensors')
+        self.sensorEntities = config.sensors
+        self.log.debug("Sensor Entities: %s", self.sensorEntities)
 
-        if len(self.sensorEntities) == 0:
-            self.log.error(
-                "No sensor entities defined. You must define at least one sensor entity.")
-
-        self.log.debug("Sensor Entities: " + str(self.sensorEntities))
-
-        event.async_track_state_change(self.hass, self.sensorEntities,
-                                       self.sensor_state_change)
+        self.router.subscribe(self.sensorEntities, self, ROLE_SENSOR)
 
     def config_static_strings(self, config):
-        DEFAULT_ON = ["on", "playing", "home"]
-        DEFAULT_OFF = ["off", "idle", "paused", "away"]
-        self.CONTROL_ON_STATE = config.get("control_states_on", DEFAULT_ON)
-        self.CONTROL_OFF_STATE = config.get("control_states_off", DEFAULT_OFF)
-        self.SENSOR_ON_STATE = config.get("sensor_states_on", DEFAULT_ON)
-        self.SENSOR_OFF_STATE = config.get("sensor_states_off", DEFAULT_OFF)
-        self.OVERRIDE_ON_STATE = config.get("override_states_on", DEFAULT_ON)
-        self.OVERRIDE_OFF_STATE = config.get("override_states_off",
-                                             DEFAULT_OFF)
-        self.STATE_ON_STATE = config.get("state_states_on", DEFAULT_ON)
-        self.STATE_OFF_STATE = config.get("state_states_off", DEFAULT_OFF)
-
-        on = config.get('state_strings_on', False)
-        if on:
-            self.CONTROL_ON_STATE.extend(on)
-            self.CONTROL_ON_STATE.extend(on)
-            self.SENSOR_ON_STATE.extend(on)
-            self.OVERRIDE_ON_STATE.extend(on)
-            self.STATE_ON_STATE.extend(on)
-
-        off = config.get('state_strings_off', False)
-        if off:
-            self.CONTROL_OFF_STATE.extend(off)
-            self.SENSOR_OFF_STATE.extend(off)
-            self.OVERRIDE_OFF_STATE.extend(off)
-            self.STATE_OFF_STATE.extend(off)
+        self.strings = config.strings
 
     def config_night_mode(self, config):
         """
@@ -606,28 +1011,14 @@ class Model():
             parameters are given, the day mode parameters are used instead. 
             If those do not exist, the 
         """
-        if "night_mode" in config:
-            self.night_mode = config["night_mode"]
-            night_mode = config["night_mode"]
-            self.light_params_night['delay'] = night_mode.get('delay',
-                                                              config.get(
-                                                                  "delay",
-                                                                  DEFAULT_DELAY))
-            self.light_params_night['service_data'] = night_mode.get(
-                'service_data', self.light_params_day.get('service_data'))
-
-            if not "start_time" in night_mode:
-                self.log.error("Night mode requires a start_time parameter !")
-
-            if not "end_time" in night_mode:
-                self.log.error("Night mode requires a end_time parameter !")
+        if config.night_params is not None:
+            self.night_mode = (config.night_start.text, config.night_end.text)
+            self.light_params_night = config.night_params
+            self.night_index = self.sun.interval(*self.night_mode)
 
     def config_normal_mode(self, config):
-        params = {}
-        params['delay'] = config.get("delay", DEFAULT_DELAY)
-        params['service_data'] = config.get("service_data", None)
-        self.log.info("serivce data set up: " + str(config))
-        self.light_params_day = params
+        self.light_params_day = config.day_params
+        self.log.debug("serivce data set up: %s", self.light_params_day)
 
     @property
     def start_time(self):
@@ -640,32 +1031,30 @@ class Model():
         return self.debug_time_wrapper(self._end_time_private)
 
     def config_times(self, config):
-        if CONFIG_START_TIME in config and CONFIG_END_TIME in config:
+        if config.start_time is not None:
             # FOR OPTIONAL DEBUGGING: for initial setup use the raw input value
-            self._start_time_private = config.get(CONFIG_START_TIME)
-            self._end_time_private = config.get(CONFIG_END_TIME)
-            self.log.debug("DEbugging start ==========================================")
-            self.dump_sun()
-            start_time_parsed = self.parse_time(self.start_time)
-            self.log.debug("start_time_parsed: %s",
-                           start_time_parsed)
-
-            self.log.debug("futurize outputs %s", self.futurize(start_time_parsed))
-
-            self.log.debug("DEbugging end ==========================================")
-            parsed_start = self.parse_time(self.start_time, aware=False)
-            parsed_end = self.parse_time(self.end_time, aware=False)
+            self._start_time_private = config.start_time.text
+            self._end_time_private = config.end_time.text
+            if self.log.isEnabledFor(logging.DEBUG):
+                self.log.debug("DEbugging start ==========================================")
+                self.dump_sun()
+                start_time_parsed = self.parse_time(self.start_time)
+                self.log.debug("start_time_parsed: %s",
+                               start_time_parsed)
+
+                self.log.debug("futurize outputs %s", self.futurize(start_time_parsed))
+
+                self.log.debug("DEbugging end ==========================================")
             # parsed_start = datetime.now() + timedelta(seconds=5)
             # parsed_end = datetime.now() + timedelta(seconds=10)
+            # identical boundaries of all models share one HA timer
+            parsed_start = self.constraints.subscribe(
+                self, CONSTRAIN_START, self._start_time_private)
+            parsed_end = self.constraints.subscribe(
+                self, CONSTRAIN_END, self._end_time_private)
             # FOR OPTIONAL DEBUGGING: subsequently use normal delay
-            sparts = re.search(
-                '^(now\s*[+-]\s*\d+)', config.get(CONFIG_START_TIME))
-            if sparts is not None:
-                self._start_time_private = sparts.group(1)
-            eparts = re.search(
-                '^(now\s*[+-]\s*\d+)', config.get(CONFIG_END_TIME))
-            if eparts is not None:
-                self._end_time_private = eparts.group(1)
+            self._start_time_private = config.start_time.period()
+            self._end_time_private = config.end_time.period()
 
             self.update(start=self.start_time)
             self.update(end=self.end_time)
@@ -673,113 +1062,86 @@ class Model():
             # parsed_start, parsed_end = self.adjust_times(parsed_start,
                         #                                              parsed_end)
 
-            parsed_start = self.futurize(parsed_start)
-            parsed_end = self.futurize(parsed_end)
             self.log.debug("Setting FIRST START callback for %s", parsed_start)
             self.log.debug("Setting FIRST END callback for %s", parsed_end)
 
-            self.start_time_event_hook = event.async_track_point_in_time(
-                self.hass, self.start_time_callback, parsed_start)
-            self.end_time_event_hook = event.async_track_point_in_time(
-                self.hass, self.end_time_callback, parsed_end)
-
-            if not self.now_is_between(self.start_time, self.end_time):
-                self.log.debug(
-                    "Constrain period active. Scheduling transition to 'constrained'")
-                event.async_call_later(self.hass, 1, self.constrain_entity)
+            # `now` (debugging) expressions move with the clock, so they
+            # cannot be precomputed
+            self.constraint_index = self.sun.interval(
+                self._start_time_private, self._end_time_private)
+            # checked right after setup, together with all other models
+            self.constraints.constrain_later(self)
 
     def config_override_entities(self, config):
-        self.overrideEntities = []
-        self.add(self.overrideEntities, config, 'override')
-        self.add(self.overrideEntities, config, 'overrides')
+        self.overrideEntities = config.overrides
 
         if len(self.overrideEntities) > 0:
-            self.log.debug("Override Entities: " + str(self.overrideEntities))
-            event.async_track_state_change(self.hass, self.overrideEntities,
-                                           self.override_state_change)
+            self.log.debug("Override Entities: %s", self.overrideEntities)
+            self.router.subscribe(self.overrideEntities, self, ROLE_OVERRIDE)
 
     def config_other(self, config):
         self.log.debug("Config other")
 
-        self.do_draw = config.get("draw", False)
+        self.do_draw = config.draw
 
-        if "entity_off" in config:
-            self.entityOff = config.get("entity_off", None)
+        if config.off_entities:
+            self.entityOff = config.off_entities
 
-        self.image_prefix = config.get('image_prefix', '/fsm_diagram_')
-        self.image_path = config.get('image_path', '/conf/temp')
-        self.backoff = config.get('backoff', False)
-        self.stay = config.get('stay', False)
+        self.image_prefix = config.image_prefix
+        self.image_path = config.image_path
+        self.backoff = config.backoff
+        self.stay = config.stay
 
         if self.backoff:
             self.log.debug(
                 "setting up backoff. Using delay as initial backoff value.")
-            self.backoff_factor = config.get('backoff_factor', 1.1)
-            self.backoff_max = config.get('backoff_max', 300)
-
-        self.stay = config.get("stay", False)
-
-        if config.get("sensor_type_duration"):
-            self.sensor_type = SENSOR_TYPE_DURATION
-        else:
-            self.sensor_type = SENSOR_TYPE_EVENT
+            self.backoff_factor = config.backoff_factor
+            self.backoff_max = config.backoff_max
 
+        self.sensor_type = config.sensor_type
         self.update(sensor_type=self.sensor_type)
 
+    def in_time_window(self):
+        """ Returns True if now is between start_time and end_time """
+        if self.constraint_index is not None:
+            return self.constraint_index.contains(self.clock.now())
+        return self.now_is_between(self.start_time, self.end_time)
+
     # =====================================================
     #    E V E N T   C A L L B A C K S
     # =====================================================
 
+    @callback
     def constrain_entity(self, evt):
         """
             Event callback used on component setup if current time requires entity to start in constrained state.
         """
-        self.constrain()
+        self.fire('constrain')
 
-    def end_time_callback(self, evt):
+    @callback
+    def end_time_callback(self, parsed_end):
         """
-            Called when `end_time` is reached, will change state to `constrained` and schedule `start_time` callback.
+            Called by the ConstraintScheduler when `end_time` is reached, will
+            change state to `constrained`. `parsed_end` is the next end time.
         """
-        self.log.debug("END TIME CALLBACK.")
-        # must be reparsed to get up to date sunset/sunrise times
-        # if self.debug_day_length:
-        #     x = self.make_naive(dt.now() + timedelta(seconds=int(self.debug_day_length)))
-        #     self.log.debug("using debug day lengh %s", x)
-        #
-        # else:
-        x = self.parse_time(self.end_time)
-
-
-
-        parsed_end = self.futurize(x)
         self.log.debug("END TIME CALLBACK. New callback set to %s (future)", parsed_end)
-        self.end_time_event_hook = event.async_track_point_in_time(
-            self.hass, self.end_time_callback, parsed_end)
+        self.begin()
         self.update(end_time=parsed_end)
-        # must be down here to make sure new callback is set regardless of exceptions
-        self.constrain()
+        self.fire('constrain')
+        self.commit()
 
-    def start_time_callback(self, evt):
+    @callback
+    def start_time_callback(self, parsed_start):
         """
-
-            Called when `start_time` is reached, will change state to `idle` and schedule `end_time` callback.
+            Called by the ConstraintScheduler when `start_time` is reached,
+            will change state to `idle`. `parsed_start` is the next start time.
         """
-        self.log.debug("START TIME CALLBACK.")
-        # must be reparsed to get up to date sunset/sunrise times
-        # if self.debug_day_length:
-        #     x = self.make_naive(dt.now() + timedelta(seconds=int(self.debug_day_length)))
-        #     self.log.debug("using debug day lengh %s", x)
-        # else:
-        x = self.parse_time(self.start_time)
-
-        parsed_start = self.futurize(x)
         self.log.debug("START TIME CALLBACK."
                        " New callback set to %s (future)", parsed_start)
-        self.start_time_event_hook = event.async_track_point_in_time(
-            self.hass, self.start_time_callback, parsed_start)
-
+        self.begin()
         self.update(start_time=parsed_start)
-        self.enable()
+        self.fire('enable')
+        self.commit()
     # =====================================================
     #    H E L P E R   F U N C T I O N S        ( N E W )
     # =====================================================
@@ -787,7 +1149,7 @@ class Model():
     def now_is_between(self, start_time_str, end_time_str, name=None):
         start_time = (self._parse_time(start_time_str, name))["datetime"]
         end_time = (self._parse_time(end_time_str, name))["datetime"]
-        now = dt.as_local(dt.now())
+        now = self.clock.now()
         start_date = now.replace(
             hour=start_time.hour, minute=start_time.minute,
             second=start_time.second
@@ -822,96 +1184,19 @@ class Model():
                 self._parse_time(time_str, name)["datetime"]))
 
     def _parse_time(self, time_str, name=None):
-        parsed_time = None
-        sun = None
-        offset = 0
-        parts = re.search('^(\d+)-(\d+)-(\d+)\s+(\d+):(\d+):(\d+)$',
-                          str(time_str))
-        if parts:
-            this_time = datetime(int(parts.group(1)),
-                                 int(parts.group(2)),
-                                 int(parts.group(3)),
-                                 int(parts.group(4)),
-                                 int(parts.group(5)),
-                                 int(parts.group(6)), 0)
-            parsed_time = dt.as_local(this_time)
-        else:
-            parts = re.search('^(\d+):(\d+):(\d+)$', str(time_str))
-            if parts:
-                today = dt.as_local(dt.now())
-                time_temp = time(
-                    int(parts.group(1)), int(parts.group(2)),
-                    int(parts.group(3)), 0
-                )
-                parsed_time = today.replace(hour=time_temp.hour,
-                                            minute=time_temp.minute,
-                                            second=time_temp.second,
-                                            microsecond=0)
-
-            else:
-                if time_str == "sunrise":
-                    parsed_time = self.sunrise(True)
-                    sun = "sunrise"
-                    offset = 0
-                elif time_str == "sunset":
-                    parsed_time = self.sunset(True)
-                    sun = "sunset"
-                    offset = 0
-                else:
-                    parts = re.search(
-                        '^sunrise\s*([+-])\s*(\d+):(\d+):(\d+)$', str(time_str)
-                    )
-                    if parts:
-
-                        sun = "sunrise"
-                        if parts.group(1) == "+":
-                            td = timedelta(
-                                hours=int(parts.group(2)),
-                                minutes=int(parts.group(3)),
-                                seconds=int(parts.group(4))
-                            )
-                            offset = td.total_seconds()
-                            parsed_time = (self.sunrise(True) + td)
-                        else:
-                            td = timedelta(
-                                hours=int(parts.group(2)),
-                                minutes=int(parts.group(3)),
-                                seconds=int(parts.group(4))
-                            )
-                            offset = td.total_seconds() * -1
-                            parsed_time = (self.sunrise(True) - td)
-                    else:
-                        parts = re.search(
-                            '^sunset\s*([+-])\s*(\d+):(\d+):(\d+)$',
-                            str(time_str)
-                        )
-                        if parts:
-                            sun = "sunset"
-                            if parts.group(1) == "+":
-                                td = timedelta(
-                                    hours=int(parts.group(2)),
-                                    minutes=int(parts.group(3)),
-                                    seconds=int(parts.group(4))
-                                )
-                                offset = td.total_seconds()
-                                parsed_time = (self.sunset(True) + td)
-                            else:
-                                td = timedelta(
-                                    hours=int(parts.group(2)),
-                                    minutes=int(parts.group(3)),
-                                    seconds=int(parts.group(4))
-                                )
-                                offset = td.total_seconds() * -1
-                                parsed_time = (self.sunset(True) - td)
-        if parsed_time is None:
+        expression = parse_time_expression(time_str)
+        if expression is None or expression.kind == TIME_NOW:
             if name is not None:
                 raise ValueError(
                     "%s: invalid time string: %s", name, time_str)
             else:
                 raise ValueError("invalid time string: %s", time_str)
+        parsed_time = expression.evaluate(self.clock.now(),
+                                          self.sun_event)
         # self.log.debug("Result of parsing: %s",
         #                {"datetime": parsed_time, "sun": sun, "offset": offset})
-        return {"datetime": parsed_time, "sun": sun, "offset": offset}
+        return {"datetime": parsed_time, "sun": expression.sun,
+                "offset": expression.offset.total_seconds()}
 
     def make_naive(self, dts):
         local = dt.as_local(dts)
@@ -920,9 +1205,7 @@ class Model():
                         local.microsecond)
 
     def sunset(self, aware):
-        t = get_astral_event_date(self.hass,
-                                  SUN_EVENT_SUNSET,
-                                  datetime.now().replace(hour=0))
+        t = self.sun.get(SUN_EVENT_SUNSET, self.clock.now().date())
         if aware is True:
             return dt.as_local(t)
         else:
@@ -930,38 +1213,24 @@ class Model():
 
 
     def sunrise(self, aware):
-        t = get_astral_event_date(self.hass,
-                                  SUN_EVENT_SUNRISE,
-                                  datetime.now().replace(hour=0))
+        t = self.sun.get(SUN_EVENT_SUNRISE, self.clock.now().date())
         if aware is True:
             return dt.as_local(t)
         else:
             return t
 
-    def next_sunrise(self, offset=0):
-        mod = offset
-        while True:
-
-            next_rising_dt = self.sunrise(True) + timedelta(mod)
-            if next_rising_dt > dt.now():
-                break
+    def sun_event(self, event, day):
+        """ Returns the (offset aware) sunrise or sunset on a given date """
+        return dt.as_local(self.sun.get(event, day))
 
-            mod += 1
-
-        return next_rising_dt
+    def next_sunrise(self, offset=0):
+        return next_occurrence(self.sunrise(True) + timedelta(offset),
+                               self.clock.now(), timedelta(1))
 
 
     def next_sunset(self, offset=0):
-        mod = offset
-        while True:
-
-            next_setting_dt = self.sunset(True) + timedelta(mod)
-            if next_setting_dt > dt.now():
-                break
-
-            mod += 1
-
-        return next_setting_dt
+        return next_occurrence(self.sunset(True) + timedelta(offset),
+                               self.clock.now(), timedelta(1))
 
 
     # =====================================================
@@ -996,70 +1265,62 @@ class Model():
             correct service parameters.
         """
         if self.is_night():
-            self.log.debug(
-                "Using NIGHT MODE parameters: " + str(self.light_params_night))
+            self.log.debug("Using NIGHT MODE parameters: %s",
+                           self.light_params_night)
             self.lightParams = self.light_params_night
             self.update(mode=MODE_NIGHT)
         else:
-            self.log.debug(
-                "Using DAY MODE parameters: " + str(self.light_params_day))
+            self.log.debug("Using DAY MODE parameters: %s",
+                           self.light_params_day)
             self.lightParams = self.light_params_day
             if self.night_mode is not None:
                 self.update(mode=MODE_DAY)  # only show when night mode set up
         self.update(delay=self.lightParams.get('delay'))
 
-    def call_service(self, entity, service, **kwargs):
-        """ Helper for calling HA services with the correct parameters """
-        domain, e = entity.split('.')
-        params = {}
-        if kwargs is not None:
-            params = kwargs
-
-        params['entity_id'] = entity
-
-        self.hass.services.call(domain, service, kwargs)
+    def call_service(self, entities, service, **kwargs):
+        """
+            Helper for calling HA services with the correct parameters.
+            Entities are grouped by domain and each group is switched with a
+            single service call taking the list of entity ids.
+        """
+        groups = {}
+        for e in entities:
+            ids = groups.setdefault(e.split('.')[0], [])
+            if e not in ids:
+                ids.append(e)
+
+        for domain, ids in groups.items():
+            params = dict(kwargs)
+            params['entity_id'] = ids
+            # runs on the event loop, so the call must not block on the
+            # service; only the task timing the latency waits for it
+            if self.latency is not None:
+                call = self.latency.time(
+                    LATENCY_SERVICE_CALL, self.hass.services.async_call(
+                        domain, service, params, blocking=True))
+            else:
+                call = self.hass.services.async_call(domain, service, params)
+            self.hass.async_create_task(call)
+            if self.metrics is not None:
+                self.metrics.inc(METRIC_SERVICE_CALLS, (domain, service))
         self.update(service_data=kwargs)
 
-    def matches(self, value, list):
+    def matches(self, value, states):
         """
-            Checks whether a string is contained in a list (used for matching state strings)
+            Checks whether a string is contained in a state vocabulary (used for matching state strings)
         """
-        try:
-            index = list.index(value)
-            return True
-        except ValueError:
-            return False
+        return value in states
 
     def five_seconds_from_now(self, sun):
         """ Returns a timedelta that will result in a sunrise trigger in 5 seconds time"""
 
-        return dt.now() + timedelta(seconds=5) - get_astral_event_date(
-            self.hass, sun, datetime.now())
+        return self.clock.now() + timedelta(seconds=5) - \
+            self.sun.get(sun, self.clock.now().date())
 
     def five_minutes_ago(self, sun):
         """ Returns a timedelta that will result in a sunrise trigger in 5 seconds time"""
-        return dt.now() - timedelta(minutes=5) - get_astral_event_date(
-            self.hass, sun, datetime.now())
-
-    def add(self, list, e, key=None):
-        """ Adds e (which can be a string or list or config) to the list
-            if e is defined.
-        """
-        if e is not None:
-            v = []
-            if key is not None:
-                if key in e:  # must be in separate if statement
-                    v = e[key]
-            else:
-                v = e
-
-            if type(v) == str:
-                list.append(v)
-            else:
-                list.extend(v)
-        else:
-            self.log.debug("none")
-        return len(v) > 0
+        return self.clock.now() - timedelta(minutes=5) - \
+            self.sun.get(sun, self.clock.now().date())
 
     def futurize(self, timet):
         """ Returns tomorrows time if time is in the past.
@@ -1068,24 +1329,23 @@ class Model():
 
         self.log.debug("-------------------- futurize ------------------------")
         self.log.debug("Input (naive) %s ", timet)
-        today = date.today()
+        x = self.clock.naive_now()
         try:
-            t = datetime.combine(today, timet)
+            t = datetime.combine(x.date(), timet)
         except TypeError as e:
             t = timet
-        x = datetime.now()
-        self.log.debug("input time: " + str(t))
-
-        self.log.debug("current time: " + str(x))
-        while t <= x:
-            if t <= x:
-                if self.debug_day_length is not None:
-                    t = t + timedelta(seconds=int(self.debug_day_length) ) # tomorrow!
-                else:
-                    t = t + timedelta(1)  # tomorrow!
-                self.log.debug( "Time already happened. Returning tomorrow instead. " + str(t))
+        self.log.debug("input time: %s", t)
+
+        self.log.debug("current time: %s", x)
+        if t <= x:
+            if self.debug_day_length is not None:
+                period = timedelta(seconds=int(self.debug_day_length))
             else:
-                self.log.debug( "Time still happening today. " + str(t))
+                period = timedelta(1)
+            t = next_occurrence(t, x, period)  # tomorrow!
+            self.log.debug("Time already happened. Returning tomorrow instead. %s", t)
+        else:
+            self.log.debug("Time still happening today. %s", t)
         self.log.debug("output time: %s", t)
         self.log.debug("-------------------- futurize (END) -------------------")
         return t
@@ -1110,26 +1370,12 @@ class Model():
             See config_times.
         """
         s = timet
-        parts = re.search(
-            '^now\s*([+-])\s*(\d+)\s*\(?(\d+)?\)?$', timet
-        )
-        if parts:
-            sign = parts.group(1)
-            first_delay = parts.group(3)
-            delay = parts.group(2)
-            # self.log.debug("Group 1: %s", sign)
-            # self.log.debug("Group 2 (delay): %s", delay)
-            # self.log.debug("Group 3 (first delay): %s", first_delay)
-            now = dt.now()
+        expression = parse_time_expression(timet)
+        if expression is not None and expression.kind == TIME_NOW:
+            now = self.clock.now()
             self.log.debug("now %s", now)
-            delta = timedelta(seconds=int(delay))
-            if first_delay is not None:
-                # self.log.debug("first delay defined")
-                delta = timedelta(seconds=int(first_delay))
-            if sign == '-':
-                now = now - delta
-            else:
-                now = now + delta
+            # first delay (in parenthesis) is used on initial setup only
+            now = now + expression.offset
 
             # self.log.debug("now + delta %s", now)
 
@@ -1147,15 +1393,997 @@ class Model():
         self.log.debug("End time:               %s", self._end_time_private)
         self.log.debug("Start time (property):  %s", self.start_time)
         self.log.debug("End time (property):    %s", self.end_time)
-        self.log.debug("DT Now:                 %s", dt.now())
-        self.log.debug("datetime Now:           %s", datetime.now())
+        self.log.debug("DT Now:                 %s", self.clock.now())
+        self.log.debug("datetime Now:           %s", self.clock.naive_now())
         self.log.debug("Next Sunrise:           %s", self.next_sunrise(True))
         self.log.debug("Next Sunset:            %s", self.next_sunset(True))
         self.log.debug("Sunrise:                %s", self.sunrise(True))
         self.log.debug("Sunset:                 %s", self.sunset(True))
         self.log.debug("--------------------------------------------------")
         self.log.debug("Sunset Diff (to now): %s",
-                       self.next_sunset() - dt.now())
+                       self.next_sunset() - self.clock.now())
         self.log.debug("Sunrise Diff(to now): %s",
-                       self.next_sunset() - dt.now())
+                       self.next_sunset() - self.clock.now())
         self.log.debug("--------------------------------------------------")
+
+
+DEFAULT_STATES_ON = ('on', 'playing', 'home')
+DEFAULT_STATES_OFF = ('off', 'idle', 'paused', 'away')
+StateStrings = namedtuple('StateStrings', [
+    # frozensets of state strings, the first fields are indexed by role
+    'sensor_on', 'state_on', 'override_on', 'control_on',
+    'sensor_off', 'state_off', 'override_off', 'control_off'])
+STATE_STRING_KEYS = (
+    'state_strings_on', 'state_strings_off',
+    'sensor_states_on', 'state_states_on', 'override_states_on',
+    'control_states_on', 'sensor_states_off', 'state_states_off',
+    'override_states_off', 'control_states_off')
+SHARED = {}  # immutable configuration values shared by all models
+
+
+def entry_record(name, config):
+    """
+        Returns the EntryConfig of a motion light validated by ENTRY_SCHEMA,
+        with the entity ids of all synonymous keys merged into tuples and
+        the light parameters of both modes resolved.
+    """
+    def entities(*keys):
+        return entity_tuple(e for key in keys for e in config.get(key, ()))
+
+    day_params = {'delay': config[CONF_DELAY],
+                  'service_data': config.get('service_data')}
+    night_mode = config.get(CONF_NIGHT_MODE)
+    night_params = night_start = night_end = None
+    if night_mode is not None:
+        night_params = {
+            'delay': night_mode.get(CONF_DELAY, config[CONF_DELAY]),
+            'service_data': night_mode.get('service_data',
+                                           config.get('service_data'))}
+        night_start = night_mode[CONFIG_START_TIME]
+        night_end = night_mode[CONFIG_END_TIME]
+    return EntryConfig(
+        name=name,
+        friendly_name=config.get('friendly_name'),
+        sensors=entities('sensor', CONF_SENSORS),
+        entities=entities('entity', CONF_CONTROL, 'entity_on'),
+        state_entities=entities(CONF_STATE),
+        overrides=entities('override', 'overrides'),
+        off_entities=entities('entity_off'),
+        sensor_type=(SENSOR_TYPE_DURATION if config['sensor_type_duration']
+                     else SENSOR_TYPE_EVENT),
+        strings=state_strings(config),
+        day_params=day_params,
+        night_params=night_params,
+        night_start=night_start,
+        night_end=night_end,
+        start_time=config.get(CONFIG_START_TIME),
+        end_time=config.get(CONFIG_END_TIME),
+        stay=config['stay'],
+        backoff=config['backoff'],
+        backoff_factor=config['backoff_factor'],
+        backoff_max=config['backoff_max'],
+        day_length=config.get('day_length'),
+        draw=config['draw'],
+        image_path=config['image_path'],
+        image_prefix=config['image_prefix'],
+        log_level=config.get(CONF_LOG_LEVEL),
+        trace_size=config[CONF_TRACE_SIZE])
+
+
+def state_strings(config):
+    """
+        Returns the StateStrings of a motion light. Motion lights with the
+        same vocabularies share one StateStrings, which is only built for the
+        first of them.
+    """
+    key = ('strings',) + tuple(tuple(config.get(k, ()))
+                               for k in STATE_STRING_KEYS)
+    if key not in SHARED:
+        on = config.get('state_strings_on')
+        off = config.get('state_strings_off')
+
+        def vocabulary(key, default, extra):
+            return state_vocabulary(config.get(key, default), extra)
+
+        SHARED[key] = share(StateStrings(
+            vocabulary("sensor_states_on", DEFAULT_STATES_ON, on),
+            vocabulary("state_states_on", DEFAULT_STATES_ON, on),
+            vocabulary("override_states_on", DEFAULT_STATES_ON, on),
+            vocabulary("control_states_on", DEFAULT_STATES_ON, on),
+            vocabulary("sensor_states_off", DEFAULT_STATES_OFF, off),
+            vocabulary("state_states_off", DEFAULT_STATES_OFF, off),
+            vocabulary("override_states_off", DEFAULT_STATES_OFF, off),
+            vocabulary("control_states_off", DEFAULT_STATES_OFF, off)))
+    return SHARED[key]
+
+
+def share(value):
+    """ Returns the shared instance equal to the (hashable) `value` """
+    return SHARED.setdefault(value, value)
+
+
+def state_vocabulary(states, extra=None):
+    """ Returns the shared frozenset of the (interned) state strings """
+    return share(frozenset(sys.intern(str(state))
+                           for vocabulary in (listify(states), listify(extra))
+                           for state in vocabulary))
+
+
+def entity_tuple(entity_ids):
+    """ Returns a tuple of the (interned) entity ids """
+    return tuple(sys.intern(str(e)) for e in entity_ids)
+
+
+def trigger_method(trigger):
+    """ Returns a Model method processing `trigger` with the model's machine """
+    def method(self):
+        return self.machine.trigger_event(self, trigger)
+    method.__name__ = trigger
+    return method
+
+
+def state_method(state):
+    """ Returns a Model method checking whether the model is in `state` """
+    def method(self):
+        return self.state == state
+    method.__name__ = 'is_' + state
+    return method
+
+
+for _trigger in {t['trigger'] for t in TRANSITIONS}:
+    setattr(Model, _trigger, trigger_method(_trigger))
+for _state in STATES:
+    if isinstance(_state, dict):
+        for _child in _state['children']:
+            setattr(Model, 'is_' + _state['name'] + '_' + _child,
+                    state_method(_state['name'] + '_' + _child))
+        _state = _state['name']
+    setattr(Model, 'is_' + _state, state_method(_state))
+
+
+def listify(obj):
+    """ Wraps a single value (or None) in a list """
+    if obj is None:
+        return []
+    return list(obj) if isinstance(obj, (list, tuple)) else [obj]
+
+
+def next_occurrence(t, now, period):
+    """
+        Returns the first occurrence of `t` repeating every `period` that is
+        after `now`, computed in one step however far `t` is in the past.
+    """
+    if t > now:
+        return t
+    return t + period * ((now - t) // period + 1)
+
+
+def write_trace(path, traces):
+    """ Appends the given traces to `path`, one JSON record per line """
+    with open(path, 'a') as file:
+        for entity_id, records in traces.items():
+            for record in records:
+                file.write(json.dumps(dict(record, entity_id=entity_id),
+                                      default=str) + '\n')
+
+
+@lru_cache(maxsize=1024)
+def parse_time_expression(time_str):
+    """
+        Compiles a time string into a TimeExpression, or returns None if the
+        string is not valid. Results are cached, so each distinct string is
+        only matched against the patterns once.
+    """
+    time_str = str(time_str)
+    parts = RE_DATETIME.match(time_str)
+    if parts:
+        return TimeExpression(TIME_DATETIME, time_str, value=datetime(
+            *[int(p) for p in parts.groups()]))
+    parts = RE_TIME.match(time_str)
+    if parts:
+        return TimeExpression(TIME_OF_DAY, time_str, value=time(
+            *[int(p) for p in parts.groups()]))
+    parts = RE_SUN.match(time_str)
+    if parts:
+        offset = timedelta(0)
+        if parts.group(2) is not None:
+            offset = timedelta(hours=int(parts.group(3)),
+                               minutes=int(parts.group(4)),
+                               seconds=int(parts.group(5)))
+            if parts.group(2) == '-':
+                offset = -offset
+        return TimeExpression(TIME_SUN, time_str, sun=parts.group(1),
+                              offset=offset)
+    parts = RE_NOW.match(time_str)
+    if parts:
+        sign = -1 if parts.group(1) == '-' else 1
+        delay = int(parts.group(2))
+        first_delay = parts.group(3)
+        return TimeExpression(
+            TIME_NOW, time_str, value=sign * delay,
+            offset=timedelta(seconds=sign * int(first_delay or delay)))
+    return None
+
+
+class TimeExpression():
+    """
+        A time string compiled by parse_time_expression. Depending on `kind`,
+        `value` holds a datetime, a time of day or the signed period (in
+        seconds) of a `now` expression; `offset` is the sun event offset or
+        the first delay of a `now` expression.
+    """
+
+    def __init__(self, kind, text, value=None, sun=None, offset=timedelta(0)):
+        self.kind = kind
+        self.text = text
+        self.value = value
+        self.sun = sun
+        self.offset = offset
+
+    def __repr__(self):
+        return 'TimeExpression(%r)' % self.text
+
+    def evaluate(self, now, sun_event):
+        """
+            Returns the (offset aware) datetime this expression refers to on
+            the day of `now`. `sun_event` returns the datetime of a sun event
+            given its name and date.
+        """
+        if self.kind == TIME_DATETIME:
+            return dt.as_local(self.value)
+        if self.kind == TIME_OF_DAY:
+            return now.replace(hour=self.value.hour, minute=self.value.minute,
+                               second=self.value.second, microsecond=0)
+        if self.kind == TIME_SUN:
+            return sun_event(self.sun, now.date()) + self.offset
+        return now + self.offset
+
+    def period(self):
+        """ Returns the time string without the first delay of `now` expressions """
+        if self.kind == TIME_NOW:
+            return 'now %s %d' % ('-' if self.value < 0 else '+',
+                                  abs(self.value))
+        return self.text
+
+
+class IntervalIndex():
+    """
+        Precomputed occurrences of a daily time window (e.g. night mode or
+        start_time/end_time) for yesterday, today and tomorrow, merged and
+        sorted so a lookup is a bisect. The occurrences are rebuilt when the
+        day changes, which also picks up the new sunrise/sunset times.
+    """
+
+    def __init__(self, start, end, sun_event):
+        self.start = start
+        self.end = end
+        self.sun_event = sun_event
+        self.starts = []
+        self.ends = []
+        self.valid_from = None
+        self.valid_until = None
+
+    @classmethod
+    def create(cls, start_str, end_str, sun_event):
+        """ Returns an index for the window, None if it cannot be precomputed """
+        start = parse_time_expression(start_str)
+        end = parse_time_expression(end_str)
+        if start is None or end is None or TIME_NOW in (start.kind, end.kind):
+            return None
+        return cls(start, end, sun_event)
+
+    def contains(self, now):
+        """ Returns True if the (offset aware) datetime `now` is in the window """
+        if self.valid_from is None or \
+                not self.valid_from <= now < self.valid_until:
+            self.rebuild(now)
+        i = bisect_right(self.starts, now) - 1
+        return i >= 0 and now <= self.ends[i]
+
+    def rebuild(self, now):
+        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
+        intervals = []
+        for days in (-1, 0, 1):
+            day = midnight + timedelta(days=days)
+            start = self.bound(self.start, day)
+            end = self.bound(self.end, day)
+            if end < start:
+                # Spans midnight
+                end = end + timedelta(days=1)
+            intervals.append([start, end])
+        intervals.sort()
+        merged = []
+        for start, end in intervals:
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self.starts = [start for start, _ in merged]
+        self.ends = [end for _, end in merged]
+        self.valid_from = midnight
+        self.valid_until = midnight + timedelta(days=1)
+
+    def bound(self, expression, day):
+        """ Time of day of `expression` on `day`, like now_is_between """
+        t = dt.as_local(expression.evaluate(day, self.sun_event))
+        return day.replace(hour=t.hour, minute=t.minute, second=t.second)
+
+
+class LatencyHistogram():
+    """ Histogram of durations (in seconds) over the fixed LATENCY_BUCKETS """
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def observe(self, value):
+        self.buckets[bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.maximum:
+            self.maximum = value
+
+    def as_dict(self):
+        labels = ['<=%gms' % (b * 1000) for b in LATENCY_BUCKETS]
+        labels.append('>%gms' % (LATENCY_BUCKETS[-1] * 1000))
+        return {
+            'count': self.count,
+            'mean_ms': (round(self.total / self.count * 1000, 3)
+                        if self.count else None),
+            'max_ms': round(self.maximum * 1000, 3),
+            'buckets': dict(zip(labels, self.buckets)),
+        }
+
+
+class LatencyStats():
+    """
+        One LatencyHistogram per stage of LATENCY_STAGES. Observations are
+        also recorded in the `parent` (component-wide) statistics, if any.
+    """
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.histograms = {stage: LatencyHistogram()
+                           for stage in LATENCY_STAGES}
+
+    def observe(self, stage, value):
+        self.histograms[stage].observe(value)
+        if self.parent is not None:
+            self.parent.observe(stage, value)
+
+    async def time(self, stage, coro):
+        """ Awaits `coro` and records how long it took """
+        start = monotonic()
+        try:
+            return await coro
+        finally:
+            self.observe(stage, monotonic() - start)
+
+    def as_dict(self):
+        return {stage: histogram.as_dict()
+                for stage, histogram in self.histograms.items()}
+
+
+class MetricsRegistry():
+    """
+        Component-wide counters of METRICS, keyed by metric name and the
+        tuple of label values, rendered in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.counters = {name: {} for name, _, _ in METRICS}
+
+    def inc(self, name, labels=(), value=1):
+        counter = self.counters[name]
+        counter[labels] = counter.get(labels, 0) + value
+
+    def render(self):
+        lines = []
+        for name, description, label_names in METRICS:
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s counter' % name)
+            for labels, value in sorted(self.counters[name].items(),
+                                        key=lambda item: str(item[0])):
+                if label_names:
+                    lines.append('%s{%s} %s' % (name, ','.join(
+                        '%s="%s"' % (label, str(v).replace('"', '\\"'))
+                        for label, v in zip(label_names, labels)), value))
+                else:
+                    lines.append('%s %s' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        """ Replaces the file at `path` with the current metrics """
+        with open(path + '.tmp', 'w') as file:
+            file.write(self.render())
+        os.replace(path + '.tmp', path)
+
+
+@lru_cache(maxsize=None)
+def metrics_view():
+    """ Returns the metrics view class, importing the HTTP component """
+    from aiohttp import web
+    from homeassistant.components.http import HomeAssistantView
+
+    class LightingSMMetricsView(HomeAssistantView):
+        """ Serves the metrics registry in the Prometheus text format """
+
+        url = METRICS_URL
+        name = 'api:' + DOMAIN + ':metrics'
+
+        def __init__(self, metrics):
+            self.metrics = metrics
+
+        async def get(self, request):
+            return web.Response(text=self.metrics.render(),
+                                content_type='text/plain')
+
+    return LightingSMMetricsView
+
+
+class TriggerError(Exception):
+    """ Raised when a trigger is not valid in the current state """
+
+
+@lru_cache(maxsize=None)
+def transitions_machine():
+    """ Returns the TransitionsMachine class, importing transitions """
+    from transitions.extensions import HierarchicalMachine
+
+    class TransitionsMachine(HierarchicalMachine):
+        """ HierarchicalMachine for models with class-level triggers """
+
+        def __init__(self, *args, **kwargs):
+            self.model_classes = set()
+            super().__init__(*args, **kwargs)
+
+        def add_model(self, model, initial=None):
+            """
+                Only the first model of a class is scanned for callbacks
+                (models of the same class have the same ones), the others
+                are just set to the initial state. Skips the O(n) check for
+                duplicate models.
+            """
+            if type(model) not in self.model_classes:
+                self.model_classes.add(type(model))
+                return super().add_model(model, initial)
+            self.set_state(self.initial if initial is None else initial,
+                           model=model)
+            self.models.append(model)
+
+        def trigger_event(self, model, trigger):
+            return self.events[trigger].trigger(model)
+
+        def _checked_assignment(self, model, name, func):
+            # Model already defines the triggers and state checks
+            if not hasattr(model, name):
+                setattr(model, name, func)
+
+    return TransitionsMachine
+
+
+class CompiledMachine():
+    """
+        Alternative to the transitions HierarchicalMachine with the same
+        semantics for the STATES and TRANSITIONS used by this component.
+
+        The definition is compiled into a static table mapping
+        (state, trigger) to the ordered candidate transitions, with nested
+        state resolution, exit/enter callbacks and condition functions
+        resolved up front. Processing a trigger is then a dict lookup plus
+        the condition and callback calls. The result of every condition is
+        appended to the model's `condition_results` list, if it has one.
+    """
+
+    def __init__(self, states, transitions, initial, prepare_event=None,
+                 finalize_event=None):
+        self.initial = initial
+        self.prepare_event = prepare_event
+        self.finalize_event = finalize_event
+        self.parents = {}  # state -> parent state (None for top level)
+        self.initials = {}  # parent state -> initial child state
+        for state in states:
+            if isinstance(state, dict):
+                name = state['name']
+                self.parents[name] = None
+                for child in state.get('children', []):
+                    self.parents[name + '_' + child] = name
+                if state.get('initial'):
+                    self.initials[name] = name + '_' + state['initial']
+            else:
+                self.parents[state] = None
+        self.triggers = []
+        self.definitions = {}  # (source, trigger) -> [transition definition]
+        for transition in transitions:
+            self.add_transition(**transition)
+        self.tables = {}  # model class -> compiled dispatch table
+
+    def add_transition(self, trigger, source, dest, conditions=None,
+                       unless=None, after=None):
+        sources = list(self.parents) if source == '*' else listify(source)
+        if trigger not in self.triggers:
+            self.triggers.append(trigger)
+        for state in sources:
+            self.definitions.setdefault((state, trigger), []).append(
+                (listify(conditions), listify(unless), dest, listify(after)))
+        self.tables = {}
+
+    def path(self, state):
+        """ Returns the list of states from the top level down to `state` """
+        path = []
+        while state is not None:
+            path.insert(0, state)
+            state = self.parents[state]
+        return path
+
+    def compile(self, cls):
+        """ Builds the (state, trigger) dispatch table for a model class """
+        def method(name):
+            return getattr(cls, name, None)
+
+        table = {}
+        for state in self.parents:
+            for trigger in self.triggers:
+                # nested states inherit the transitions of their parents
+                source = state
+                while source is not None and \
+                        (source, trigger) not in self.definitions:
+                    source = self.parents[source]
+                if source is None:
+                    continue
+                entries = []
+                for conditions, unless, dest, after in \
+                        self.definitions[(source, trigger)]:
+                    checks = tuple([(method(c), True) for c in conditions] +
+                                   [(method(c), False) for c in unless])
+                    exits = enters = ()
+                    if dest is not None:
+                        while dest in self.initials:
+                            dest = self.initials[dest]
+                        src_path = self.path(state)
+                        dest_path = self.path(dest)
+                        common = 0
+                        while common < min(len(src_path), len(dest_path)) \
+                                and src_path[common] == dest_path[common]:
+                            common += 1
+                        if common == len(dest_path):
+                            common -= 1  # (re-)entering self or a parent
+                        exits = tuple(f for f in (
+                            method('on_exit_' + s)
+                            for s in reversed(src_path[common:])) if f)
+                        enters = tuple(f for f in (
+                            method('on_enter_' + s)
+                            for s in dest_path[common:]) if f)
+                    entries.append((checks, dest, exits, enters,
+                                    tuple(method(a) for a in after)))
+                table[(state, trigger)] = tuple(entries)
+        return table
+
+    def add_model(self, model, initial=None):
+        cls = type(model)
+        if cls not in self.tables:
+            self.tables[cls] = self.compile(cls)
+        for trigger in self.triggers:
+            if not hasattr(model, trigger):
+                setattr(model, trigger, partial(self.trigger, model, trigger))
+        for state in self.parents:
+            if not hasattr(model, 'is_' + state):
+                setattr(model, 'is_' + state,
+                        partial(self.is_state, state, model))
+        model.state = initial or self.initial
+
+    def is_state(self, state, model):
+        return model.state == state
+
+    def trigger_event(self, model, trigger):
+        return self.trigger(model, trigger)
+
+    def trigger(self, model, trigger):
+        """ Processes `trigger` for `model`, returns True if a transition ran """
+        entries = self.tables[type(model)].get((model.state, trigger))
+        if entries is None:
+            raise TriggerError("Can't trigger event %s from state %s!" % (
+                trigger, model.state))
+        results = getattr(model, 'condition_results', None)
+        if self.prepare_event is not None:
+            getattr(model, self.prepare_event)()
+        try:
+            for checks, dest, exits, enters, after in entries:
+                for func, target in checks:
+                    result = func(model)
+                    if results is not None:
+                        results.append((func.__name__, result))
+                    if result != target:
+                        break
+                else:
+                    if dest is not None:
+                        for func in exits:
+                            func(model)
+                        model.state = dest
+                        for func in enters:
+                            func(model)
+                    for func in after:
+                        func(model)
+                    return True
+            return False
+        finally:
+            if self.finalize_event is not None:
+                getattr(model, self.finalize_event)()
+
+
+class HassClock():
+    """
+        The wall clock and the Home Assistant event loop. `call_later` and
+        `track_point_in_time` call back with the current datetime like the
+        HA helpers they wrap; `call_at` takes a deadline in `time()` seconds.
+    """
+
+    def __init__(self, hass):
+        self.hass = hass
+
+    def now(self):
+        """ Returns the current (aware, local) datetime """
+        return dt.now()
+
+    def naive_now(self):
+        return datetime.now()
+
+    def time(self):
+        """ Returns the monotonic time used by call_at """
+        return self.hass.loop.time()
+
+    def call_at(self, when, callback):
+        return self.hass.loop.call_at(when, callback)
+
+    def call_later(self, delay, callback):
+        return event.async_call_later(self.hass, delay, callback)
+
+    def track_point_in_time(self, callback, point):
+        return event.async_track_point_in_time(self.hass, callback, point)
+
+
+class VirtualClock():
+    """
+        Simulated clock with the interface of HassClock, for tests and
+        simulations. Time stands still until advance() is called, which
+        runs the callbacks that became due in deadline order, with the clock
+        set to each deadline in turn. A simulated day takes as long as its
+        callbacks take to run.
+    """
+
+    def __init__(self, start=None):
+        self.start = dt.as_local(start or dt.now())
+        self.elapsed = 0.0
+        self.queue = []  # heap of (deadline, sequence, VirtualHandle)
+        self.sequence = 0
+
+    def now(self):
+        return self.start + timedelta(seconds=self.elapsed)
+
+    def naive_now(self):
+        return self.now().replace(tzinfo=None)
+
+    def time(self):
+        return self.elapsed
+
+    def call_at(self, when, callback, *args):
+        handle = VirtualHandle(callback, args)
+        self.sequence += 1
+        heappush(self.queue, (when, self.sequence, handle))
+        return handle
+
+    def call_later(self, delay, callback):
+        return self.call_at(self.elapsed + delay, self._call_with_now,
+                            callback)
+
+    def track_point_in_time(self, callback, point):
+        delay = (dt.as_local(point) if point.tzinfo else
+                 point.replace(tzinfo=self.start.tzinfo)) - self.now()
+        return self.call_later(max(delay.total_seconds(), 0), callback)
+
+    def _call_with_now(self, callback):
+        callback(self.now())
+
+    def advance(self, seconds):
+        """ Moves the clock forward, running every callback that is due """
+        target = self.elapsed + seconds
+        while self.queue and self.queue[0][0] <= target:
+            when, _, handle = heappop(self.queue)
+            if handle.cancelled:
+                continue
+            self.elapsed = max(self.elapsed, when)
+            try:
+                handle.callback(*handle.args)
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception("Error running callback %s",
+                                  handle.callback)
+        self.elapsed = max(self.elapsed, target)
+
+    def advance_to(self, point):
+        """ Moves the clock forward to the (aware) datetime `point` """
+        self.advance((point - self.now()).total_seconds())
+
+
+class VirtualHandle():
+    """ Callback scheduled with a VirtualClock """
+
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class SunCache():
+    """
+        Sunrise and sunset times shared by all models. Each (event, date) is
+        computed once; when the day changes, past days are dropped and the
+        events of the following day are computed ahead of time. Models with
+        the same time window also share its IntervalIndex.
+    """
+
+    def __init__(self, hass, clock):
+        self.hass = hass
+        self.clock = clock
+        self.events = {}
+        self.today = None
+        self.intervals = {}
+
+    def interval(self, start_str, end_str):
+        """ Returns the shared IntervalIndex of a window (see create) """
+        key = (start_str, end_str)
+        if key not in self.intervals:
+            self.intervals[key] = IntervalIndex.create(start_str, end_str,
+                                                       self.local)
+        return self.intervals[key]
+
+    def local(self, event, day):
+        """ Returns the (offset aware, local) datetime of a sun event """
+        return dt.as_local(self.get(event, day))
+
+    def get(self, event, day):
+        """ Returns the (UTC) datetime of a sun event on a given local date """
+        try:
+            return self.events[(event, day)]
+        except KeyError:
+            pass
+        today = self.clock.now().date()
+        if today != self.today:
+            self.today = today
+            yesterday = today - timedelta(days=1)
+            self.events = {k: v for k, v in self.events.items()
+                           if k[1] >= yesterday}
+            tomorrow = today + timedelta(days=1)
+            for sun_event in (SUN_EVENT_SUNRISE, SUN_EVENT_SUNSET):
+                self.compute(sun_event, tomorrow)
+        return self.compute(event, day)
+
+    def compute(self, event, day):
+        key = (event, day)
+        if key not in self.events:
+            from homeassistant.helpers.sun import get_astral_event_date
+            self.events[key] = get_astral_event_date(self.hass, event, day)
+        return self.events[key]
+
+
+class ConstraintScheduler():
+    """
+        Shared timers for the start_time/end_time windows of all models.
+        Models with an identical boundary (same time string and day length)
+        subscribe to one ConstraintBoundary, which keeps a single HA timer and
+        fans `enable`/`constrain` out to every subscriber when it fires.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.boundaries = {}
+        self.pending = []  # models to constrain right after setup
+
+    def subscribe(self, model, role, time_str):
+        """
+            Subscribes `model` to the boundary described by `time_str` as its
+            start (CONSTRAIN_START) or end (CONSTRAIN_END) time. Returns the
+            datetime the boundary fires next.
+        """
+        key = (time_str, model.debug_day_length)
+        boundary = self.boundaries.get(key)
+        if boundary is None:
+            boundary = ConstraintBoundary(self.clock, time_str, model)
+            self.boundaries[key] = boundary
+        boundary.subscribers.append((model, role))
+        return boundary.next_time
+
+    def constrain_later(self, model):
+        """
+            Constrains `model` shortly after setup, together with all others,
+            if it is outside its time window then.
+        """
+        if not self.pending:
+            self.clock.call_later(1, self.constrain_pending)
+        self.pending.append(model)
+
+    @callback
+    def constrain_pending(self, evt):
+        pending, self.pending = self.pending, []
+        for model in pending:
+            if not model.in_time_window():
+                model.log.debug("Constrain period active")
+                model.constrain_entity(evt)
+
+
+class ConstraintBoundary():
+    """ A start or end time shared by one or more models """
+
+    def __init__(self, clock, time_str, model):
+        self.clock = clock
+        # time strings are evaluated by the first subscriber, which has the
+        # same sun location and day length as every other subscriber
+        self.model = model
+        self.period = parse_time_expression(time_str).period()
+        self.subscribers = []
+        self.next_time = None
+        self.schedule(time_str)
+
+    def schedule(self, time_str):
+        # must be reparsed to get up to date sunset/sunrise times
+        parsed = self.model.parse_time(self.model.debug_time_wrapper(time_str))
+        self.next_time = self.model.futurize(parsed)
+        self.clock.track_point_in_time(self.fire, self.next_time)
+
+    @callback
+    def fire(self, evt):
+        # must come first to make sure the new callback is set regardless of exceptions
+        self.schedule(self.period)
+        for model, role in self.subscribers:
+            if role == CONSTRAIN_START:
+                model.start_time_callback(self.next_time)
+            else:
+                model.end_time_callback(self.next_time)
+
+
+class StateChangeRouter():
+    """
+        Component-wide index from entity_id to the (model, role) pairs
+        subscribed to it. A single `state_changed` listener routes every
+        event to the interested models with one dict lookup, instead of
+        each model registering its own listeners.
+    """
+
+    def __init__(self, hass):
+        self.hass = hass
+        self.index = {}
+        self.unsub = None
+
+    def subscribe(self, entity_ids, model, role):
+        """ Routes state changes of `entity_ids` to `model` in `role` """
+        for entity_id in entity_ids:
+            entity_id = entity_id.lower()
+            subscribers = self.index.setdefault(entity_id, [])
+            if (model, role) not in subscribers:
+                subscribers.append((model, role))
+                model.track_state(role, entity_id,
+                                  self.hass.states.get(entity_id))
+
+    def start(self):
+        """ Registers the state_changed listener (once) """
+        if self.unsub is None:
+            self.unsub = self.hass.bus.async_listen(EVENT_STATE_CHANGED,
+                                                    self.state_changed)
+
+    @callback
+    def state_changed(self, evt):
+        entity_id = evt.data.get('entity_id')
+        subscribers = self.index.get(entity_id)
+        if subscribers is None:
+            return
+        new = evt.data.get('new_state')
+        old = evt.data.get('old_state')
+        # update every role first so callbacks see a consistent aggregate
+        for model, role in subscribers:
+            model.track_state(role, entity_id, new)
+        if new is None:  # entity removed, nothing to dispatch
+            return
+        for model, role in subscribers:
+            model.route_state_change(role, entity_id, old, new)
+
+
+class TimerWheel():
+    """
+        Hashed timing wheel shared by all models of the component.
+
+        Deadlines are hashed into `slots` buckets of `resolution` seconds.
+        Scheduling, rescheduling and cancelling a timer are O(1). A single
+        callback scheduled with the clock advances the wheel while timers are
+        pending and dispatches expired timers on the loop thread.
+    """
+
+    def __init__(self, clock, resolution=TIMER_RESOLUTION, slots=TIMER_SLOTS):
+        self.clock = clock
+        self.resolution = resolution
+        self.slots = [set() for _ in range(slots)]
+        self.origin = clock.time()
+        self.tick = 0  # last tick processed
+        self.pending = 0
+        self.handle = None  # loop handle of the next tick, None when idle
+
+    def schedule(self, delay, callback):
+        """ Returns a WheelTimer calling `callback` after `delay` seconds """
+        timer = WheelTimer(self, callback)
+        self.reschedule(timer, delay)
+        return timer
+
+    def reschedule(self, timer, delay):
+        """ Moves an (expired, cancelled or running) timer to a new deadline """
+        now = self.clock.time() - self.origin
+        self._remove(timer)
+        if self.pending == 0:
+            # nothing queued, skip the ticks elapsed while idle
+            self.tick = max(int(now // self.resolution), self.tick)
+        deadline = now + delay
+        # round up so a timer never fires early
+        timer.tick = max(-int(-deadline // self.resolution), self.tick + 1)
+        timer.slot = self.slots[timer.tick % len(self.slots)]
+        timer.slot.add(timer)
+        self.pending += 1
+        if self.handle is None:
+            self._arm()
+
+    def cancel(self, timer):
+        self._remove(timer)
+
+    def _remove(self, timer):
+        if timer.slot is not None:
+            timer.slot.discard(timer)
+            timer.slot = None
+            self.pending -= 1
+
+    def _arm(self):
+        self.handle = self.clock.call_at(
+            self.origin + (self.tick + 1) * self.resolution, self._advance)
+
+    def _advance(self):
+        """ Processes every tick that elapsed since the last call """
+        now = int((self.clock.time() - self.origin) // self.resolution)
+        expired = []
+        # after a full revolution every slot has been visited
+        steps = min(now - self.tick, len(self.slots))
+        for tick in range(self.tick + 1, self.tick + 1 + steps):
+            slot = self.slots[tick % len(self.slots)]
+            for timer in [t for t in slot if t.tick <= now]:
+                self._remove(timer)
+                expired.append(timer)
+        self.tick = max(now, self.tick)
+        if self.pending > 0:
+            self._arm()
+        else:
+            self.handle = None
+
+        for timer in expired:
+            try:
+                timer.callback()
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.exception("Error running timer callback %s",
+                                  timer.callback)
+
+
+class WheelTimer():
+    """ Handle of a deadline registered with the TimerWheel """
+
+    def __init__(self, wheel, callback):
+        self.wheel = wheel
+        self.callback = callback
+        self.tick = None
+        self.slot = None  # slot the timer is queued in, None when not running
+
+    def is_alive(self):
+        return self.slot is not None
+
+    def cancel(self):
+        self.wheel.cancel(self)
+
+    def reschedule(self, delay):
+        self.wheel.reschedule(self, delay)
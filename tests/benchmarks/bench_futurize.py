@@ -0,0 +1,61 @@
+"""
+Benchmark futurize and next_sunrise/next_sunset with pathological inputs.
+
+futurize used to step one period at a time until the input was in the
+future, so a stale input combined with a short `day_length` took one loop
+iteration (and several log calls) per elapsed period. Every case below must
+now take roughly the same (constant) time.
+
+Run from the root of the Home Assistant development checkout:
+
+    python -m tests.benchmarks.bench_futurize
+"""
+import logging
+import timeit
+from datetime import datetime, timedelta
+
+from homeassistant.components import lightingsm
+from homeassistant.setup import setup_component
+from tests.common import get_test_home_assistant
+
+ROUNDS = 1000
+
+CASES = [
+    # (description, day_length, time offset from now)
+    ('time of day, still to come', None, timedelta(hours=1)),
+    ('time of day, already passed', None, timedelta(hours=-1)),
+    ('datetime 5 years stale', None, timedelta(days=-5 * 365)),
+    ('1s day length, 1 day stale', 1, timedelta(days=-1)),
+    ('1s day length, 1 year stale', 1, timedelta(days=-365)),
+]
+
+
+def main():
+    hass = get_test_home_assistant()
+    try:
+        assert setup_component(hass, lightingsm.DOMAIN, {lightingsm.DOMAIN: {
+            'bench': {'entity': 'light.bench', 'sensor': 'binary_sensor.bench'}
+        }})
+        model = lightingsm.devices[-1].model
+        model.log.setLevel(logging.WARNING)
+
+        print("%-32s %12s" % ("case", "us/call"))
+        for description, day_length, offset in CASES:
+            model.debug_day_length = day_length
+            value = datetime.now() + offset
+            seconds = timeit.timeit(lambda: model.futurize(value),
+                                    number=ROUNDS)
+            print("%-32s %12.2f" % (description, seconds / ROUNDS * 1e6))
+
+        for name in ('next_sunrise', 'next_sunset'):
+            for offset in (0, 1, 365):
+                seconds = timeit.timeit(
+                    lambda: getattr(model, name)(offset), number=ROUNDS)
+                print("%-32s %12.2f" % ("%s(offset=%d)" % (name, offset),
+                                        seconds / ROUNDS * 1e6))
+    finally:
+        hass.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+Benchmark the import cost of the lightingsm component.
+
+Every run imports the component in a fresh interpreter with `-X importtime`,
+after the Home Assistant modules that are loaded at boot anyway, and reports
+the median of:
+
+    self_ms         executing the module body
+    cumulative_ms   including the modules imported because of lightingsm
+    transitions     whether the transitions package was loaded
+    engine_ms       first use of the transitions engine (importing transitions)
+
+Run from the root of the Home Assistant development checkout:
+
+    python -m tests.benchmarks.bench_import --runs 20
+"""
+import argparse
+import json
+import re
+import statistics
+import subprocess
+import sys
+
+MODULE = 'homeassistant.components.lightingsm'
+PRELOADED = [
+    'homeassistant.core',
+    'homeassistant.helpers.config_validation',
+    'homeassistant.helpers.entity_component',
+    'homeassistant.helpers.event',
+]
+RE_IMPORTTIME = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|\s*(\S+)$')
+SCRIPT = """
+import json, sys
+from time import monotonic
+%s
+import %s as component
+start = monotonic()
+loaded = 'transitions' in sys.modules
+component.transitions_machine()
+print(json.dumps({'transitions': loaded,
+                  'engine_ms': (monotonic() - start) * 1000}))
+""" % ('\n'.join('import ' + module for module in PRELOADED), MODULE)
+
+
+def run():
+    """ Imports the component in a child process and returns its timings """
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', SCRIPT],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            check=True, universal_newlines=True)
+    timings = json.loads(result.stdout.strip().splitlines()[-1])
+    for line in result.stderr.splitlines():
+        match = RE_IMPORTTIME.match(line)
+        if match and match.group(3) == MODULE:
+            timings['self_ms'] = int(match.group(1)) / 1000
+            timings['cumulative_ms'] = int(match.group(2)) / 1000
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    runs = [run() for _ in range(args.runs)]
+    print(json.dumps({
+        'self_ms': round(statistics.median(r['self_ms'] for r in runs), 2),
+        'cumulative_ms': round(
+            statistics.median(r['cumulative_ms'] for r in runs), 2),
+        'transitions': any(r['transitions'] for r in runs),
+        'engine_ms': round(statistics.median(r['engine_ms'] for r in runs), 2),
+    }))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,80 @@
+"""
+Benchmark the memory used per lightingsm motion light.
+
+Sets up N motion lights in a test Home Assistant instance (tests/common.py)
+and reports, per motion light, the memory allocated by the setup (as traced
+by tracemalloc, including the HA state and entity registry overhead) and
+the shallow size of the Model and its instance __dict__ (if any).
+
+Run from the root of the Home Assistant development checkout:
+
+    python -m tests.benchmarks.bench_memory --sizes 1000 5000
+"""
+import argparse
+import asyncio
+import gc
+import sys
+import tracemalloc
+
+from homeassistant.components import lightingsm
+from homeassistant.setup import async_setup_component
+from tests.common import async_test_home_assistant
+
+SIZES = [1000, 5000]
+
+
+async def run(loop, size, engine):
+    hass = await async_test_home_assistant(loop)
+    hass.data[lightingsm.DOMAIN] = {
+        lightingsm.DATA_CLOCK: lightingsm.VirtualClock()}
+    config = {'options': {'engine': engine}}
+    for i in range(size):
+        config['motion_light_%d' % i] = {
+            'sensor': 'binary_sensor.motion_%d' % i,
+            'entity': 'light.light_%d' % i,
+        }
+
+    gc.collect()
+    before = tracemalloc.take_snapshot()
+    assert await async_setup_component(hass, lightingsm.DOMAIN,
+                                       {lightingsm.DOMAIN: config})
+    await hass.async_block_till_done()
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+
+    allocated = sum(stat.size_diff
+                    for stat in after.compare_to(before, 'filename'))
+    model = lightingsm.devices[-1].model
+    instance_dict = model.__dict__ if hasattr(model, '__dict__') else {}
+    await hass.async_stop(force=True)
+    return {
+        'size': size,
+        'engine': engine,
+        'bytes_per_entity': allocated // size,
+        'model_bytes': sys.getsizeof(model),
+        'model_dict_bytes': sys.getsizeof(instance_dict),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--engines', nargs='+',
+                        default=[lightingsm.ENGINE_TRANSITIONS,
+                                 lightingsm.ENGINE_COMPILED])
+    args = parser.parse_args()
+
+    tracemalloc.start()
+    loop = asyncio.new_event_loop()
+    print("%-12s %8s %18s %12s %16s" % (
+        "engine", "N", "bytes/entity", "model", "model __dict__"))
+    for engine in args.engines:
+        for size in args.sizes:
+            result = loop.run_until_complete(run(loop, size, engine))
+            print("%-12s %8d %18d %12d %16d" % (
+                engine, size, result['bytes_per_entity'],
+                result['model_bytes'], result['model_dict_bytes']))
+
+
+if __name__ == '__main__':
+    main()
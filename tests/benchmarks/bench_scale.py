@@ -0,0 +1,244 @@
+"""
+Benchmark lightingsm with many motion lights.
+
+For every size N, a fresh Home Assistant instance (tests/common.py) is set
+up with N motion lights in a separate process, so that peak RSS and thread
+count are not inflated by earlier runs. A seeded, synthetic stream of
+sensor on/off events is then replayed and the following are measured:
+
+    setup_s         async_setup_component of the lightingsm domain
+    setup_phases    seconds per phase of the component setup (not compared)
+    events_per_s    replay throughput (each event is processed to completion)
+    p50_ms, p99_ms  sensor state change to light.turn_on service call
+    expiry_s        time for all timers to expire after the last event
+                    (with --clock virtual, the time to process the expiry)
+    peak_rss_mb     peak resident set size of the process
+    threads         peak number of threads
+
+Run from the root of the Home Assistant development checkout:
+
+    python -m tests.benchmarks.bench_scale --output results.json
+    python -m tests.benchmarks.bench_scale --baseline results.json
+
+With --baseline, the results are compared with an earlier results file and
+the process exits with status 1 if any metric regressed by more than
+--threshold percent. No baseline is shipped; record one on the machine the
+comparison runs on.
+"""
+import argparse
+import asyncio
+import json
+import platform
+import random
+import resource
+import subprocess
+import sys
+import threading
+from datetime import timedelta
+from time import monotonic
+
+from homeassistant.components import lightingsm
+from homeassistant.core import callback
+from homeassistant.setup import async_setup_component
+import homeassistant.util.dt as dt
+from tests.common import async_fire_time_changed, async_test_home_assistant
+
+SIZES = [10, 100, 1000, 5000]
+ROUNDS = 2  # on/off pairs per motion light and replay
+DELAY = 1  # motion light delay (seconds)
+SEED = 1
+CLOCK_HASS = 'hass'
+CLOCK_VIRTUAL = 'virtual'  # seeded into hass.data before setup
+
+# metric -> True if larger values are better
+METRICS = {
+    'setup_s': False,
+    'events_per_s': True,
+    'p50_ms': False,
+    'p99_ms': False,
+    'expiry_s': False,
+    'peak_rss_mb': False,
+    'threads': False,
+}
+
+
+def percentile_ms(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1,
+                            int(len(values) * fraction))] * 1000, 3)
+
+
+def event_stream(size, rounds, seed):
+    """ Returns a shuffled list of (index, state) sensor events """
+    rnd = random.Random(seed)
+    events = []
+    for _ in range(rounds):
+        batch = [(i, state) for i in range(size) for state in ('on', 'off')]
+        rnd.shuffle(batch)
+        # the first event of each sensor turns it on, the second off
+        seen = set()
+        for n, (i, _) in enumerate(batch):
+            batch[n] = (i, 'off' if i in seen else 'on')
+            seen.add(i)
+        events.extend(batch)
+    return events
+
+
+async def run(loop, size, engine, clock):
+    hass = await async_test_home_assistant(loop)
+    threads = threading.active_count()
+    pending = {}  # light -> monotonic time of the sensor event
+    latencies = []
+    turned_off = set()
+
+    @callback
+    def turn_on(call):
+        now = monotonic()
+        for entity_id in call.data['entity_id']:
+            start = pending.pop(entity_id, None)
+            if start is not None:
+                latencies.append(now - start)
+
+    @callback
+    def turn_off(call):
+        turned_off.update(call.data['entity_id'])
+
+    hass.services.async_register('light', 'turn_on', turn_on)
+    hass.services.async_register('light', 'turn_off', turn_off)
+
+    if clock == CLOCK_VIRTUAL:
+        hass.data[lightingsm.DOMAIN] = {
+            lightingsm.DATA_CLOCK: lightingsm.VirtualClock()}
+    config = {'options': {'engine': engine}}
+    for i in range(size):
+        hass.states.async_set('binary_sensor.motion_%d' % i, 'off')
+        hass.states.async_set('light.light_%d' % i, 'off')
+        config['motion_light_%d' % i] = {
+            'sensor': 'binary_sensor.motion_%d' % i,
+            'entity': 'light.light_%d' % i,
+            'delay': DELAY,
+        }
+
+    start = monotonic()
+    assert await async_setup_component(hass, lightingsm.DOMAIN,
+                                       {lightingsm.DOMAIN: config})
+    await hass.async_block_till_done()
+    setup = monotonic() - start
+    phases = dict(hass.data[lightingsm.DOMAIN][lightingsm.DATA_SETUP])
+    # flush the delayed initial state writes of all entities
+    async_fire_time_changed(hass, dt.utcnow() + timedelta(seconds=2))
+    await hass.async_block_till_done()
+    threads = max(threads, threading.active_count())
+
+    events = event_stream(size, ROUNDS, SEED)
+    start = monotonic()
+    for i, state in events:
+        light = 'light.light_%d' % i
+        if state == 'on':
+            pending.setdefault(light, monotonic())
+        hass.states.async_set('binary_sensor.motion_%d' % i, state)
+        await hass.async_block_till_done()
+        pending.pop(light, None)  # retrigger without a service call
+    replay = monotonic() - start
+    threads = max(threads, threading.active_count())
+
+    start = monotonic()
+    if clock == CLOCK_VIRTUAL:
+        hass.data[lightingsm.DOMAIN][lightingsm.DATA_CLOCK].advance(
+            DELAY + lightingsm.TIMER_RESOLUTION)
+        await hass.async_block_till_done()
+    while len(turned_off) < size and monotonic() - start < DELAY + 10:
+        await asyncio.sleep(0.1)
+    expiry = monotonic() - start
+
+    await hass.async_stop(force=True)
+    return {
+        'size': size,
+        'engine': engine,
+        'clock': clock,
+        'setup_s': round(setup, 4),
+        'setup_phases': phases,
+        'events_per_s': round(len(events) / replay, 1),
+        'p50_ms': percentile_ms(latencies, 0.5),
+        'p99_ms': percentile_ms(latencies, 0.99),
+        'expiry_s': round(expiry, 3),
+        'peak_rss_mb': round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'threads': threads,
+    }
+
+
+def run_size(size, engine, clock):
+    """ Runs one size in a child process and returns its results """
+    output = subprocess.check_output([
+        sys.executable, '-m', 'tests.benchmarks.bench_scale',
+        '--single', str(size), '--engine', engine, '--clock', clock])
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def compare(results, baseline, threshold):
+    """ Prints the change against `baseline`, returns True on regressions """
+    regressed = False
+    previous = {r['size']: r for r in baseline['results']}
+    for result in results['results']:
+        base = previous.get(result['size'])
+        if base is None:
+            continue
+        for metric, larger_is_better in METRICS.items():
+            old, new = base.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            worse = -change if larger_is_better else change
+            flag = ''
+            if worse > threshold:
+                flag = '  REGRESSION'
+                regressed = True
+            print("N=%-6d %-14s %12s -> %-12s %+7.1f%%%s" % (
+                result['size'], metric, old, new, change, flag))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--engine', default=lightingsm.DEFAULT_ENGINE)
+    parser.add_argument('--clock', default=CLOCK_HASS,
+                        choices=[CLOCK_HASS, CLOCK_VIRTUAL])
+    parser.add_argument('--output', help="write the results to this file")
+    parser.add_argument('--baseline', help="compare with this results file")
+    parser.add_argument('--threshold', type=float, default=20,
+                        help="regression threshold in percent")
+    parser.add_argument('--single', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single is not None:
+        loop = asyncio.new_event_loop()
+        print(json.dumps(loop.run_until_complete(
+            run(loop, args.single, args.engine, args.clock))))
+        return
+
+    results = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': [],
+    }
+    for size in args.sizes:
+        result = run_size(size, args.engine, args.clock)
+        results['results'].append(result)
+        print(json.dumps(result))
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            if compare(results, json.load(file), args.threshold):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
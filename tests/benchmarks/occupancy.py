@@ -0,0 +1,240 @@
+"""
+Generate synthetic occupancy traces and replay them against lightingsm.
+
+A trace is a CSV file of `offset,entity_id,state` rows sorted by offset
+(seconds since the start of the trace). Every room has a motion sensor,
+a light and an override input_boolean:
+
+    binary_sensor.room_<n>_motion    event sensor, short on/off pulses
+    binary_sensor.room_<n>_duration  duration sensor, on for a whole visit
+    light.room_<n>
+    input_boolean.room_<n>_override
+
+Visits to a room arrive as a Poisson process and last an exponentially
+distributed dwell time. During a visit, event sensors pulse repeatedly and
+duration sensors stay on. Overrides (e.g. the TV) are toggled on and off as
+an independent Poisson process.
+
+Replaying sets up one motion light per room in a test Home Assistant
+instance (tests/common.py) and feeds the sensor and override state changes
+through the component's state change routing, in real or virtual time.
+The component's timers run on the same clock as the trace. The component
+metrics are reported at the end, so runs with different delay, backoff or
+engine settings can be compared.
+
+Run from the root of the Home Assistant development checkout:
+
+    python -m tests.benchmarks.occupancy generate trace.csv --rooms 500
+    python -m tests.benchmarks.occupancy replay trace.csv --clock virtual
+"""
+import argparse
+import asyncio
+import csv
+import random
+import re
+from time import monotonic
+
+from homeassistant.components import lightingsm
+from homeassistant.core import callback
+from homeassistant.setup import async_setup_component
+from tests.common import async_test_home_assistant
+
+RE_SENSOR = re.compile(r'^binary_sensor\.room_(\d+)_(motion|duration)$')
+PULSE_HOLD = 5  # seconds an event sensor stays on per pulse
+CLOCK_HASS = 'hass'
+CLOCK_VIRTUAL = 'virtual'  # seeded into hass.data before setup
+
+
+def generate(rooms, hours, visits_per_hour=2.0, dwell=600.0,
+             pulse_interval=45.0, duration_fraction=0.3,
+             overrides_per_hour=0.1, override_length=1800.0, seed=1):
+    """ Returns a sorted list of (offset, entity_id, state) events """
+    rnd = random.Random(seed)
+    end = hours * 3600
+    events = []
+    for room in range(rooms):
+        duration = rnd.random() < duration_fraction
+        sensor = 'binary_sensor.room_%d_%s' % (
+            room, 'duration' if duration else 'motion')
+        t = rnd.expovariate(visits_per_hour / 3600)
+        while t < end:
+            leave = min(t + rnd.expovariate(1 / dwell), end)
+            if duration:
+                events.append((t, sensor, 'on'))
+                events.append((leave, sensor, 'off'))
+            else:
+                pulse = t
+                while pulse < leave:
+                    events.append((pulse, sensor, 'on'))
+                    events.append((pulse + PULSE_HOLD, sensor, 'off'))
+                    pulse += PULSE_HOLD + rnd.expovariate(1 / pulse_interval)
+                leave = pulse  # after the last pulse has ended
+            t = leave + rnd.expovariate(visits_per_hour / 3600)
+
+        override = 'input_boolean.room_%d_override' % room
+        t = rnd.expovariate(overrides_per_hour / 3600)
+        while t < end:
+            off = t + rnd.expovariate(1 / override_length)
+            events.append((t, override, 'on'))
+            events.append((off, override, 'off'))
+            t = off + rnd.expovariate(overrides_per_hour / 3600)
+    events.sort()
+    return events
+
+
+def write_trace(path, events):
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['offset', 'entity_id', 'state'])
+        for offset, entity_id, state in events:
+            writer.writerow(['%.3f' % offset, entity_id, state])
+
+
+def read_trace(path):
+    with open(path, newline='') as file:
+        reader = csv.reader(file)
+        next(reader)
+        return [(float(offset), entity_id, state)
+                for offset, entity_id, state in reader]
+
+
+def motion_lights(events, delay, backoff, backoff_factor, backoff_max):
+    """ Returns the lightingsm configuration of the rooms in a trace """
+    config = {}
+    for _, entity_id, _ in events:
+        match = RE_SENSOR.match(entity_id)
+        if match is None or 'room_' + match.group(1) in config:
+            continue
+        room = match.group(1)
+        light = {
+            'sensor': entity_id,
+            'entity': 'light.room_%s' % room,
+            'override': 'input_boolean.room_%s_override' % room,
+            'delay': delay,
+        }
+        if match.group(2) == 'duration':
+            light['sensor_type_duration'] = True
+        if backoff:
+            light.update(backoff=True, backoff_factor=backoff_factor,
+                         backoff_max=backoff_max)
+        config['room_' + room] = light
+    return config
+
+
+async def replay(loop, events, args):
+    hass = await async_test_home_assistant(loop)
+
+    @callback
+    def switch(call):
+        state = 'on' if call.service == 'turn_on' else 'off'
+        for entity_id in call.data['entity_id']:
+            hass.states.async_set(entity_id, state)
+
+    hass.services.async_register('light', 'turn_on', switch)
+    hass.services.async_register('light', 'turn_off', switch)
+
+    for _, entity_id, _ in events:
+        if hass.states.get(entity_id) is None:
+            hass.states.async_set(entity_id, 'off')
+
+    config = motion_lights(events, args.delay, args.backoff,
+                           args.backoff_factor, args.backoff_max)
+    for light in config.values():
+        hass.states.async_set(light['entity'], 'off')
+    if args.clock == CLOCK_VIRTUAL:
+        hass.data[lightingsm.DOMAIN] = {
+            lightingsm.DATA_CLOCK: lightingsm.VirtualClock()}
+    config['options'] = {'engine': args.engine, 'metrics': True}
+    assert await async_setup_component(hass, lightingsm.DOMAIN,
+                                       {lightingsm.DOMAIN: config})
+    await hass.async_block_till_done()
+    clock = hass.data[lightingsm.DOMAIN][lightingsm.DATA_CLOCK]
+    metrics = hass.data[lightingsm.DOMAIN][lightingsm.DATA_METRICS]
+
+    start = monotonic()
+    offset = 0
+    for when, entity_id, state in events:
+        if args.clock == CLOCK_VIRTUAL:
+            clock.advance(when - offset)
+            offset = when
+        else:
+            wait = when - (monotonic() - start)
+            if wait > 0:
+                await asyncio.sleep(wait)
+        hass.states.async_set(entity_id, state)
+        await hass.async_block_till_done()
+    if args.clock == CLOCK_VIRTUAL:
+        # let the remaining timers run out
+        clock.advance((args.backoff_max if args.backoff else args.delay) +
+                      lightingsm.TIMER_RESOLUTION)
+        await hass.async_block_till_done()
+    elapsed = monotonic() - start
+
+    await hass.async_stop(force=True)
+    return len(config) - 1, elapsed, metrics
+
+
+def report(rooms, events, elapsed, metrics):
+    print("rooms %d, events %d, trace %.0fs, replayed in %.2fs" % (
+        rooms, len(events), events[-1][0] if events else 0, elapsed))
+    for name, _, _ in lightingsm.METRICS:
+        counter = metrics.counters[name]
+        print("%s %d" % (name, sum(counter.values())))
+        for labels, value in sorted(counter.items()):
+            if labels:
+                print("    %-50s %d" % (' '.join(labels), value))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    commands = parser.add_subparsers(dest='command')
+
+    gen = commands.add_parser('generate', help="write a synthetic trace")
+    gen.add_argument('trace')
+    gen.add_argument('--rooms', type=int, default=100)
+    gen.add_argument('--hours', type=float, default=24)
+    gen.add_argument('--visits-per-hour', type=float, default=2.0)
+    gen.add_argument('--dwell', type=float, default=600.0,
+                     help="mean visit length (seconds)")
+    gen.add_argument('--pulse-interval', type=float, default=45.0,
+                     help="mean time between event sensor pulses (seconds)")
+    gen.add_argument('--duration-fraction', type=float, default=0.3,
+                     help="fraction of rooms with duration sensors")
+    gen.add_argument('--overrides-per-hour', type=float, default=0.1)
+    gen.add_argument('--override-length', type=float, default=1800.0,
+                     help="mean override length (seconds)")
+    gen.add_argument('--seed', type=int, default=1)
+
+    rep = commands.add_parser('replay', help="replay a trace")
+    rep.add_argument('trace')
+    rep.add_argument('--clock', default=CLOCK_VIRTUAL,
+                     choices=[CLOCK_HASS, CLOCK_VIRTUAL])
+    rep.add_argument('--engine', default=lightingsm.DEFAULT_ENGINE)
+    rep.add_argument('--delay', type=int, default=lightingsm.DEFAULT_DELAY)
+    rep.add_argument('--backoff', action='store_true')
+    rep.add_argument('--backoff-factor', type=float, default=1.1)
+    rep.add_argument('--backoff-max', type=int, default=300)
+    rep.add_argument('--metrics', help="write Prometheus metrics to a file")
+
+    args = parser.parse_args()
+    if args.command == 'generate':
+        events = generate(args.rooms, args.hours, args.visits_per_hour,
+                          args.dwell, args.pulse_interval,
+                          args.duration_fraction, args.overrides_per_hour,
+                          args.override_length, args.seed)
+        write_trace(args.trace, events)
+        print("wrote %d events for %d rooms" % (len(events), args.rooms))
+    elif args.command == 'replay':
+        events = read_trace(args.trace)
+        loop = asyncio.new_event_loop()
+        rooms, elapsed, metrics = loop.run_until_complete(
+            replay(loop, events, args))
+        report(rooms, events, elapsed, metrics)
+        if args.metrics:
+            metrics.write(args.metrics)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,10 @@
 """The tests for the input_boolean component."""
 # pylint: disable=protected-access
 import asyncio
+import itertools
 import logging
 import pytest
+import voluptuous as vol
 from unittest.mock import patch
 from datetime import timedelta
 from homeassistant.core import CoreState, State, Context
@@ -13,6 +15,8 @@ from homeassistant.const import (
     STATE_ON, STATE_OFF, ATTR_ENTITY_ID, ATTR_FRIENDLY_NAME, ATTR_ICON,
     SERVICE_TOGGLE, SERVICE_TURN_OFF, SERVICE_TURN_ON)
 import homeassistant.util.dt as dt
+from homeassistant.components import lightingsm
+from transitions.extensions import HierarchicalMachine
 from tests.common import (
     mock_component, mock_restore_cache, async_fire_time_changed)
 
@@ -73,6 +77,8 @@ async def test_config_options(hass_et):
     hass.state = CoreState.starting
     _LOGGER.debug('ENTITIES @ start: %s', hass.states.async_entity_ids())
 
+    clock = lightingsm.VirtualClock()
+    hass.data[lightingsm.DOMAIN] = {lightingsm.DATA_CLOCK: clock}
     assert await async_setup_component(hass, 'lightingsm', {'lightingsm': {
         'test': {'entity': CONTROL_ENTITY,
                  'sensor': SENSOR_ENTITY
@@ -92,12 +98,260 @@ async def test_config_options(hass_et):
 
     assert hass.states.get(ENTITY).state == STATE_ACTIVE
 
-    # with patch(('threading.timer.dt_util.utcnow'), return_value=future):
-    #     async_fire_time_changed(hass, future)
-    #     await hass.async_block_till_done()
-    # future = dt.utcnow() + timedelta(seconds=300)
-    # async_fire_time_changed(hass, future)
-    # assert state(hass) == STATE_IDLE
+    clock.advance(lightingsm.DEFAULT_DELAY - 10)
+    await hass.async_block_till_done()
+    assert state(hass) == STATE_ACTIVE
+
+    clock.advance(20)
+    await hass.async_block_till_done()
+    assert state(hass) == STATE_IDLE
+
+
+async def test_latency_diagnostics(hass_et):
+    """Test the diagnostics entity reports the latency histograms."""
+    hass = hass_et
+    hass.states.async_set(CONTROL_ENTITY, 'off')
+    hass.states.async_set(SENSOR_ENTITY, 'off')
+    assert await async_setup_component(hass, 'lightingsm', {'lightingsm': {
+        'options': {'latency': True},
+        'test': {'entity': CONTROL_ENTITY,
+                 'sensor': SENSOR_ENTITY
+                 },
+    }})
+    await hass.async_block_till_done()
+
+    hass.states.async_set(SENSOR_ENTITY, 'on')
+    await hass.async_block_till_done()
+    assert state(hass) == STATE_ACTIVE
+
+    # the diagnostics entity is polled
+    async_fire_time_changed(hass, dt.utcnow() + timedelta(seconds=30))
+    await hass.async_block_till_done()
+
+    diagnostics = hass.states.get(lightingsm.DOMAIN + '.diagnostics')
+    assert diagnostics.state == '1'
+    stage = lightingsm.LATENCY_EVENT_TO_TRANSITION
+    assert diagnostics.attributes['global'][stage]['count'] == 1
+    assert diagnostics.attributes[ENTITY][stage]['count'] == 1
+
+
+async def test_dump_trace(hass_et):
+    """Test the trace of recent triggers is fired as an event."""
+    hass = hass_et
+    assert await async_setup_component(hass, 'lightingsm', {'lightingsm': {
+        'test': {'entity': CONTROL_ENTITY,
+                 'sensor': SENSOR_ENTITY,
+                 'trace_size': 2
+                 },
+    }})
+    hass.states.async_set(CONTROL_ENTITY, 'off')
+    hass.states.async_set(SENSOR_ENTITY, 'off')
+    await hass.async_block_till_done()
+    for _ in range(3):
+        hass.states.async_set(SENSOR_ENTITY, 'on')
+        await hass.async_block_till_done()
+        hass.states.async_set(SENSOR_ENTITY, 'off')
+        await hass.async_block_till_done()
+
+    events = []
+    hass.bus.async_listen(lightingsm.EVENT_TRACE, events.append)
+    await hass.services.async_call(lightingsm.DOMAIN,
+                                   lightingsm.SERVICE_DUMP_TRACE,
+                                   {ATTR_ENTITY_ID: ENTITY}, blocking=True)
+    await hass.async_block_till_done()
+
+    trace = events[0].data['traces'][ENTITY]
+    assert len(trace) == 2
+    assert [(r['trigger'], r['source'], r['dest'], r['cause'])
+            for r in trace] == [
+        ('sensor_on', STATE_ACTIVE, STATE_ACTIVE, SENSOR_ENTITY)] * 2
+
+    # traces can only be written to files in the configuration directory
+    for filename in ('../configuration.yaml', '/tmp/trace.jsonl'):
+        with pytest.raises(vol.Invalid):
+            lightingsm.DUMP_TRACE_SCHEMA({'filename': filename})
+
+
+CONDITIONS = ['is_state_entities_off', 'is_state_entities_on',
+              'is_timer_expired', 'is_event_sensor', 'is_duration_sensor',
+              'is_sensor_off', 'will_stay_on']
+
+
+class RecordingModel():
+    """ Model recording the conditions and callbacks invoked by a machine """
+
+    def __init__(self):
+        self.calls = []
+        self.passing = set()
+
+    def on_enter_active(self):
+        self.calls.append('on_enter_active')
+        self.enter()
+
+
+def _condition(name):
+    def condition(self):
+        self.calls.append(name)
+        return name in self.passing
+    return condition
+
+
+def _callback(name):
+    def callback(self):
+        self.calls.append(name)
+    return callback
+
+
+for _name in CONDITIONS:
+    setattr(RecordingModel, _name, _condition(_name))
+for _name in ['on_enter_idle', 'on_exit_idle', 'on_enter_overridden',
+              'on_exit_active', 'on_enter_blocked', 'on_enter_constrained',
+              'on_exit_active_timer', 'on_enter_active_stay_on',
+              '_reset_timer', 'begin', 'finalize']:
+    setattr(RecordingModel, _name, _callback(_name))
+
+
+def test_compiled_engine_matches_transitions():
+    """Test the compiled engine against the transitions machine."""
+    reference = HierarchicalMachine(states=lightingsm.STATES,
+                                    initial='idle',
+                                    prepare_event='begin',
+                                    finalize_event='finalize')
+    for transition in lightingsm.TRANSITIONS:
+        reference.add_transition(**transition)
+    compiled = lightingsm.CompiledMachine(
+        states=lightingsm.STATES, transitions=lightingsm.TRANSITIONS,
+        initial='idle', prepare_event='begin', finalize_event='finalize')
+
+    models = RecordingModel(), RecordingModel()
+    reference.add_model(models[0])
+    compiled.add_model(models[1])
+
+    def run(model, state, trigger, passing):
+        model.state = state
+        model.passing = passing
+        model.calls = []
+        try:
+            result = getattr(model, trigger)()
+        except Exception:  # invalid trigger for this state
+            result = 'error'
+        return result, model.state, model.calls
+
+    for state in compiled.parents:
+        for trigger in compiled.triggers:
+            for outcome in itertools.product([True, False],
+                                             repeat=len(CONDITIONS)):
+                passing = {c for c, o in zip(CONDITIONS, outcome) if o}
+                assert run(models[0], state, trigger, passing) == \
+                    run(models[1], state, trigger, passing), \
+                    (state, trigger, passing)
+
+
+def test_next_occurrence():
+    """Test the next occurrence of a time is found in one step."""
+    now = dt.parse_datetime('2019-01-17 12:00:00')
+    day = timedelta(days=1)
+    assert lightingsm.next_occurrence(now + day, now, day) == now + day
+    assert lightingsm.next_occurrence(now, now, day) == now + day
+    assert lightingsm.next_occurrence(
+        now - 1000 * day, now, day) == now + day
+    # a short debug day length with a stale input
+    second = timedelta(seconds=1)
+    assert lightingsm.next_occurrence(
+        now - timedelta(days=365) - second / 2, now, second) == now + second / 2
+
+
+def test_config_schema():
+    """Test entries are validated into normalized EntryConfig records."""
+    config = lightingsm.CONFIG_SCHEMA({lightingsm.DOMAIN: {
+        'test': {'sensor': SENSOR_ENTITY, 'entities': CONTROL_ENTITIES,
+                 'start_time': 'sunset - 00:30:00', 'end_time': '23:00:00',
+                 'night_mode': {'start_time': '22:00:00',
+                                'end_time': '06:00:00', 'delay': 30}},
+    }})[lightingsm.DOMAIN]
+    record = config['test']
+    assert record.name == 'test'
+    assert record.sensors == (SENSOR_ENTITY,)
+    assert record.entities == tuple(CONTROL_ENTITIES)
+    assert record.start_time.kind == lightingsm.TIME_SUN
+    assert record.day_params['delay'] == lightingsm.DEFAULT_DELAY
+    assert record.night_params['delay'] == 30
+    assert config['options'][lightingsm.CONF_ENGINE] == \
+        lightingsm.DEFAULT_ENGINE
+
+    for entry in ({'entity': CONTROL_ENTITY},
+                  {'sensor': SENSOR_ENTITY},
+                  {'sensor': SENSOR_ENTITY, 'entity': CONTROL_ENTITY,
+                   'start_time': '22:00:00'},
+                  {'sensor': SENSOR_ENTITY, 'entity': CONTROL_ENTITY,
+                   'start_time': 'bogus', 'end_time': '23:00:00'},
+                  {'sensor': SENSOR_ENTITY, 'entity': CONTROL_ENTITY,
+                   'delya': 10}):
+        with pytest.raises(vol.Invalid):
+            lightingsm.CONFIG_SCHEMA({lightingsm.DOMAIN: {'test': entry}})
+    with pytest.raises(vol.Invalid):  # name of the diagnostics entity
+        lightingsm.CONFIG_SCHEMA({lightingsm.DOMAIN: {'diagnostics': {
+            'sensor': SENSOR_ENTITY, 'entity': CONTROL_ENTITY}}})
+
+
+def test_state_vocabulary():
+    """Test state vocabularies are deduplicated and shared."""
+    extra = ['open']
+    vocabulary = lightingsm.state_vocabulary(['on', 'home', 'on'], extra)
+    assert vocabulary == {'on', 'home', 'open'}
+    assert lightingsm.state_vocabulary(('home', 'open', 'on')) is vocabulary
+    assert lightingsm.state_vocabulary('on') == {'on'}
+    assert extra == ['open']
+
+
+def test_metrics_render():
+    """Test metrics are rendered in the Prometheus text format."""
+    metrics = lightingsm.MetricsRegistry()
+    metrics.inc(lightingsm.METRIC_TRANSITIONS, ('idle', STATE_ACTIVE,
+                                                'sensor_on'))
+    metrics.inc(lightingsm.METRIC_TRANSITIONS, ('idle', STATE_ACTIVE,
+                                                'sensor_on'))
+    metrics.inc(lightingsm.METRIC_BACKOFF)
+    lines = metrics.render().splitlines()
+    assert 'lightingsm_transitions_total{source="idle",dest="active_timer",' \
+           'trigger="sensor_on"} 2' in lines
+    assert 'lightingsm_backoff_increments_total 1' in lines
+    assert '# TYPE lightingsm_service_calls_total counter' in lines
+
+
+def test_timer_wheel():
+    """Test wheel timers fire at, and only at, their deadline."""
+    clock = lightingsm.VirtualClock()
+    wheel = lightingsm.TimerWheel(clock)
+    fired = {}
+
+    def timer(name, delay):
+        return wheel.schedule(delay, lambda: fired.setdefault(
+            name, clock.time()))
+
+    timer('short', 2.5)
+    moved = timer('moved', 10)
+    cancelled = timer('cancelled', 5)
+    timer('long', 600)  # more than one revolution of the wheel
+
+    clock.advance(2.4)
+    assert fired == {}
+    clock.advance(0.6)
+    assert fired == {'short': 3}
+
+    cancelled.cancel()
+    clock.advance(2)
+    moved.reschedule(20)  # now due at 25
+    clock.advance(19)  # past both old deadlines
+    assert 'moved' not in fired and not cancelled.is_alive()
+    clock.advance(1)
+    assert fired['moved'] == 25
+
+    clock.advance(600 - 25 - 1)
+    assert 'long' not in fired
+    clock.advance(1)
+    assert fired['long'] == 600
+    assert 'cancelled' not in fired and wheel.pending == 0
 
 
 def state(hass):